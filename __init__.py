@@ -1,6 +1,15 @@
+from . import file_cache
 from . import mvdxml_expression
 
-from xml.dom.minidom import parse, Element
+import os
+import sys
+import importlib.metadata
+
+from xml.dom.minidom import parse, Node
+
+# Incremented when the structure of the parsed and compiled objects changes,
+# to invalidate the files written by concept_root.load()
+CACHE_VERSION = 2
 
 class rule(object):
     """
@@ -12,6 +21,15 @@ class rule(object):
         self.tag, self.attribute, self.nodes, self.bind = tag, attribute, nodes, bind
         self.optional = optional
 
+    def copy(self):
+        """
+        Returns a detached copy of the rule subtree, sharing the parsed attributes
+        """
+        R = rule(self.tag, self.attribute, tuple(n.copy() for n in self.nodes), self.bind, optional=self.optional)
+        for n in R.nodes:
+            n.parent = R
+        return R
+
     def to_string(self, indent=0):
         # return "%s%s%s[%s](%s%s)%s" % ("\n" if indent else "", " "*indent, self.tag, self.attribute, "".join(n.to_string(indent+2) for n in self.nodes), ("\n" + " "*indent) if len(self.nodes) else "", (" -> %s" % self.bind) if self.bind else "")
         return "<%s %s%s>" % (self.tag, f"{self.bind}=" if self.bind else "", self.attribute)
@@ -19,28 +37,97 @@ class rule(object):
     def __repr__(self):
         return self.to_string()
 
+def iter_elements(node, name):
+    """
+    Yields the elements below node with the given local name in document order,
+    like getElementsByTagNameNS("*", name), but without visiting the remainder
+    of the tree before the first element is returned
+    """
+    stack = [iter(node.childNodes)]
+    while stack:
+        for n in stack[-1]:
+            if n.nodeType != Node.ELEMENT_NODE: continue
+            if n.localName == name:
+                yield n
+            stack.append(iter(n.childNodes))
+            break
+        else:
+            stack.pop()
+
+def matches(value, selector):
+    # a selector is None (anything), a single value or a collection of values
+    return selector is None or (value == selector if isinstance(selector, str) else value in selector)
+
 class template(object):
     """
     Representation of an mvdXML template
     """
 
-    def __init__(self, concept, root, constraints=None, rules=None, parent=None):
+    def __init__(self, concept, root, constraints=None, rules=None, parent=None, lazy=False):
         self.concept, self.root, self.constraints, self.parent = concept, root, (constraints or []), parent
-        self.rules = rules or []
+        self.rule_trees = rules or []
+        # when lazy, the rules are parsed on first access
+        self.pending = lazy
+        # element -> whether its subtree has a RuleID or IdPrefix
+        self.bound = {}
         self.entity = str(root.attributes['applicableEntity'].value)
         try:
             self.name = root.attributes['name'].value
         except:
             self.name = None
 
+    @property
+    def rules(self):
+        if self.pending:
+            self.pending = False
+            self.parse()
+        return self.rule_trees
+
+    @rules.setter
+    def rules(self, rules):
+        self.rule_trees, self.pending = rules, False
+
     def bind(self, constraints):
         return template(self.concept, self.root, constraints, self.rules)
 
     def parse(self, visited=None):
-        for rules in self.root.getElementsByTagNameNS("*", "Rules"):
-            for r in rules.childNodes:
-                if not isinstance(r, Element): continue
-                self.rules.append(self.parse_rule(r, visited=visited))
+        self.pending = False
+        visited = frozenset(visited or ())
+
+        def _():
+            for rules in self.root.getElementsByTagNameNS("*", "Rules"):
+                for r in rules.childNodes:
+                    if r.nodeType != Node.ELEMENT_NODE: continue
+                    yield self.parse_rule(r, visited=visited)
+
+        if self.concept is None:
+            self.rule_trees.extend(_())
+        else:
+            # a whole ConceptTemplate is compiled once per document, the
+            # resulting rule trees are shared by all concepts referencing it
+            key = (self.root.getAttribute("uuid"), None, visited)
+            compiled = self.concept.root.compiled
+            if key not in compiled:
+                compiled[key] = tuple(_())
+            self.rule_trees.extend(compiled[key])
+
+    def expand(self, ref, prefix, visited):
+        """
+        Returns the rules of the referenced ConceptTemplate with their RuleIDs
+        prefixed, compiled once per document for every (ref, prefix, visited)
+        """
+        key = (ref, prefix, visited)
+        compiled = self.concept.root.compiled
+        if key not in compiled:
+            n = self.concept.root.templates[ref]
+
+            def _():
+                for subnode in n.childNodes:
+                    if subnode.nodeType != Node.ELEMENT_NODE: continue
+                    for x in self.visit_rule(subnode, prefix, visited): yield x
+
+            compiled[key] = tuple(_())
+        return compiled[key]
 
     def traverse(self, fn, root=None, with_parents=False):
         def visit(n, p=root, ps=[root]):
@@ -58,71 +145,91 @@ class template(object):
         for r in self.rules:
             visit(r)
 
+    def has_ruleid_or_prefix(self, node):
+        """
+        Returns whether node or any element below it has a RuleID or IdPrefix. The
+        subtree is annotated bottom-up on first use, so that the nested rules it
+        contains are answered from the annotation instead of rescanning.
+        """
+        if node not in self.bound:
+            # post-order, children are annotated before their parent
+            stack = [(node, None)]
+            while stack:
+                n, children = stack.pop()
+                if children is None:
+                    children = [c for c in n.childNodes if c.nodeType == Node.ELEMENT_NODE]
+                    stack.append((n, children))
+                    stack.extend((c, None) for c in children if c not in self.bound)
+                else:
+                    self.bound[n] = "RuleID" in n.attributes or "IdPrefix" in n.attributes or \
+                        any(self.bound[c] for c in children)
+        return self.bound[node]
+
     def parse_rule(self, root, visited=None):
-        def visit(node, prefix="", visited=None, parent=None):
-            r = None
-            n = node
-            nm = None
-            p = prefix
-            optional = False
-            visited = set() if visited is None else visited
-
-            if node.localName == "AttributeRule":
-                r = node.attributes["AttributeName"].value
+        return next(self.visit_rule(root, "", frozenset(visited or ())))
+
+    def visit_rule(self, node, prefix, visited):
+        r = None
+        n = node
+        nm = None
+        p = prefix
+        optional = False
+
+        if node.localName == "AttributeRule":
+            r = node.attributes["AttributeName"].value
+            try:
+                nm = node.attributes["RuleID"].value
+            except:
+                # without binding, it's wrapped in a SPARQL OPTIONAL {} clause
+                # Aim is to insert this clause once as high in the stack as possible
+                # All topmost attribute rules are optional anyway as in the binding requirements on existence is specified
+                optional = node.parentNode.localName == "Rules" or not self.has_ruleid_or_prefix(node)
+        elif node.localName == "EntityRule":
+            r = node.attributes["EntityName"].value
+        elif node.localName == "Template":
+            ref = node.attributes['ref'].value
+            # we break infinite recursion using this set
+            if ref not in visited:
                 try:
-                    nm = node.attributes["RuleID"].value
+                    p = p + node.attributes["IdPrefix"].value
                 except:
-                    # without binding, it's wrapped in a SPARQL OPTIONAL {} clause
-                    # Aim is to insert this clause once as high in the stack as possible
-                    # All topmost attribute rules are optional anyway as in the binding requirements on existence is specified
-
-                    def child_has_ruleid_or_prefix(node):
-                        if type(node).__name__ == "Element":
-                            if "RuleID" in node.attributes or "IdPrefix" in node.attributes:
-                                return True
-                            for n in node.childNodes:
-                                if child_has_ruleid_or_prefix(n): return True
-
-                    optional = node.parentNode.localName == "Rules" or not child_has_ruleid_or_prefix(node)
-            elif node.localName == "EntityRule":
-                r = node.attributes["EntityName"].value
-            elif node.localName == "Template":
-                ref = node.attributes['ref'].value
-                # we break infinite recursion using this set
-                if ref not in visited:
-                    n = self.concept.template(ref, visited=visited | {ref}).root
-                    try:
-                        p = p + node.attributes["IdPrefix"].value
-                    except:
-                        pass
-            elif node.localName == "Constraint":
-                r = mvdxml_expression.parse(node.attributes["Expression"].value)
-            elif node.localName == "EntityRules": pass
-            elif node.localName == "AttributeRules": pass
-            elif node.localName == "Rules": pass
-            elif node.localName == "Constraints": pass
-            elif node.localName == "References": pass
-            elif node.localName == "Definitions": return
-            elif node.localName == "SubTemplates": return # @todo perhaps just traverse them?
-            else:
-                raise ValueError(node.localName)
-
-            def _(n):
-                for subnode in n.childNodes:
-                    if not isinstance(subnode, Element): continue
-                    for x in visit(subnode, p, visited=visited): yield x
-
-            if r:
-                R = rule(node.localName, r, list(_(n)), (p + nm) if nm else nm, optional=optional)
-                for rr in R.nodes:
-                    rr.parent = R
-                yield R
-            else:
-                for subnode in n.childNodes:
-                    if not isinstance(subnode, Element): continue
-                    for x in visit(subnode, p, visited=visited): yield x
-
-        return list(visit(root, visited=visited))[0]
+                    pass
+                for x in self.expand(ref, p, visited | {ref}): yield x
+                return
+        elif node.localName == "Constraint":
+            r = mvdxml_expression.parse(node.attributes["Expression"].value)
+        elif node.localName == "EntityRules": pass
+        elif node.localName == "AttributeRules": pass
+        elif node.localName == "Rules": pass
+        elif node.localName == "Constraints": pass
+        elif node.localName == "References": pass
+        elif node.localName == "Definitions": return
+        elif node.localName == "SubTemplates": return # @todo perhaps just traverse them?
+        else:
+            raise ValueError(node.localName)
+
+        def _(n):
+            for subnode in n.childNodes:
+                if subnode.nodeType != Node.ELEMENT_NODE: continue
+                for x in self.visit_rule(subnode, p, visited): yield x
+
+        if r:
+            nodes = []
+            for rr in _(n):
+                if rr.parent is not None:
+                    # Already attached elsewhere, as part of a compiled template. Every
+                    # position in the tree needs distinct nodes, as extracted data is
+                    # keyed on them.
+                    rr = rr.copy()
+                nodes.append(rr)
+            R = rule(node.localName, r, tuple(nodes), (p + nm) if nm else nm, optional=optional)
+            for rr in R.nodes:
+                rr.parent = R
+            yield R
+        else:
+            for subnode in n.childNodes:
+                if subnode.nodeType != Node.ELEMENT_NODE: continue
+                for x in self.visit_rule(subnode, p, visited): yield x
 
 class concept_or_applicability(object):
     """
@@ -143,14 +250,22 @@ class concept_or_applicability(object):
         if id is None:
             id = self.concept_node.getElementsByTagNameNS("*","Template")[0].attributes['ref'].value
 
-        for node in self.root.dom.getElementsByTagNameNS('*',"ConceptTemplate"):
-            if node.attributes["uuid"].value == id:
-                t = template(self, node)
-                t.parse(visited=visited)
-                t_with_rules = t.bind(self.rules())
-                return t_with_rules
+        node = self.root.templates.get(id)
+        if node is not None:
+            t = template(self, node)
+            t.parse(visited=visited)
+            t_with_rules = t.bind(self.rules())
+            return t_with_rules
 
     def rules(self):
+        # parsed once per document, stored with the compiled templates
+        key = ("TemplateRules", self.concept_node)
+        compiled = self.root.compiled
+        if key not in compiled:
+            compiled[key] = self.parse_rules()
+        return compiled[key]
+
+    def parse_rules(self):
         # Get the top most TemplateRule and traverse
         try:
             rules = self.concept_node.getElementsByTagNameNS("*","TemplateRules")[0]
@@ -159,7 +274,7 @@ class concept_or_applicability(object):
 
         def visit(rules):
             def _():
-                for i, r in enumerate([c for c in rules.childNodes if isinstance(c, Element)]):
+                for i, r in enumerate([c for c in rules.childNodes if c.nodeType == Node.ELEMENT_NODE]):
                     if i:
                         yield rules.attributes["operator"].value
                     if r.localName == "TemplateRules":
@@ -173,28 +288,161 @@ class concept_or_applicability(object):
 
         return visit(rules)
 
+def index_templates(dom):
+    """
+    Maps ConceptTemplate uuids to their DOM nodes, so that template references
+    can be resolved without scanning the document
+    """
+    return {
+        node.attributes["uuid"].value: node
+        for node in dom.getElementsByTagNameNS("*","ConceptTemplate")
+        if "uuid" in node.attributes
+    }
+
 class concept_root(object):
-    def __init__(self, dom, root):
+    def __init__(self, dom, root, templates=None, compiled=None):
         self.dom, self.root = dom, root
+        # the index and compiled rule trees are shared by all concept roots of a document
+        self.templates = index_templates(dom) if templates is None else templates
+        self.compiled = {} if compiled is None else compiled
         self.name = root.attributes['name'].value
         self.entity = str(root.attributes['applicableRootEntity'].value)
 
     def applicability(self):
-        return concept_or_applicability(self, self.root.getElementsByTagNameNS("*","Applicability")[0])
+        node = next(iter_elements(self.root, "Applicability"), None)
+        if node is None:
+            raise IndexError("ConceptRoot %s has no Applicability" % self.name)
+        return concept_or_applicability(self, node)
+
+    def concepts(self, name=None, uuid=None):
+        """
+        Yields the Concepts of the ConceptRoot as they are found in the document,
+        their templates are only resolved when calling template()
+
+        :param name: Concept name, or collection of names, to select
+        :param uuid: Concept uuid, or collection of uuids, to select
+        """
+        for c in iter_elements(self.root, "Concept"):
+            if matches(c.getAttribute("name"), name) and matches(c.getAttribute("uuid"), uuid):
+                yield concept_or_applicability(self, c)
 
-    def concepts(self):
-        for c in self.root.getElementsByTagNameNS("*","Concept"):
-            yield concept_or_applicability(self, c)
+    @staticmethod
+    def select(fn, entity=None, name=None, uuid=None, engine="iterparse"):
+        """
+        Yields (ConceptRoot, Concept) tuples of the Concepts in an mvdXML file that
+        match all of the given selectors. Only the selected Concepts are created
+        and no templates are resolved, so that the cost is proportional to the
+        selection rather than to the size of the file.
+
+        :param fn: mvdXML filename
+        :param entity: applicableRootEntity, or collection of them, of the ConceptRoots
+        :param name: Concept name, or collection of names
+        :param uuid: Concept uuid, or collection of uuids
+        :param engine: see parse()
+        """
+        for cr in concept_root.parse(fn, engine=engine):
+            if not isinstance(cr, concept_root):
+                # a file with only ConceptTemplates
+                return
+            if matches(cr.entity, entity):
+                for c in cr.concepts(name=name, uuid=uuid):
+                    yield cr, c
 
     @staticmethod
-    def parse(fn):
+    def parse(fn, engine="minidom"):
+        """
+        Parses an mvdXML file and yields its ConceptRoots, or its ConceptTemplates
+        when the file does not contain any ConceptRoot
+
+        :param fn: mvdXML filename
+        :param engine: either 'minidom' to build a full DOM, or 'iterparse' to read
+            the file with an event parser into lightweight elements, yielding
+            ConceptRoots as soon as they are read
+        """
+        if engine == "iterparse":
+            yield from concept_root.iterparse(fn)
+            return
+        elif engine != "minidom":
+            raise ValueError(engine)
+
         dom = parse(fn)
         if len(dom.getElementsByTagNameNS("*","ConceptRoot")):
+            templates, compiled = index_templates(dom), {}
             for root in dom.getElementsByTagNameNS("*","ConceptRoot"):
-                CR = concept_root(dom, root)
+                CR = concept_root(dom, root, templates, compiled)
                 yield CR
         else:
             for templ in dom.getElementsByTagNameNS("*","ConceptTemplate"):
-                t = template(None, templ)
-                t.parse()
-                yield t
+                yield template(None, templ, lazy=True)
+
+    @staticmethod
+    def load(fn, cache_dir=None):
+        """
+        Returns the ConceptRoots of an mvdXML file, or its ConceptTemplates when
+        the file does not contain any ConceptRoot, as a list. The file is read
+        with the iterparse engine and the templates and TemplateRules of all
+        Concepts are compiled. The result is stored in cache_dir, keyed by the
+        hash of the file contents, CACHE_VERSION and the Python and pyparsing
+        versions, so that subsequent loads of the same file skip parsing altogether.
+        A cached file that cannot be loaded is replaced.
+
+        :param fn: mvdXML filename
+        :param cache_dir: directory of the cached files, by default
+            $XDG_CACHE_HOME/ifcopenshell/mvd or ~/.cache/ifcopenshell/mvd
+        """
+        if cache_dir is None:
+            cache_dir = file_cache.default_cache_dir()
+
+        # the expressions that pyparsing handles are stored as its ParseResults
+        try:
+            pyparsing_version = importlib.metadata.version("pyparsing")
+        except importlib.metadata.PackageNotFoundError:
+            pyparsing_version = None
+        cache_fn = os.path.join(cache_dir, file_cache.file_digest(
+            fn, str(CACHE_VERSION), "%d.%d" % sys.version_info[:2], str(pyparsing_version)) + ".pickle")
+
+        items = file_cache.load_pickle(cache_fn)
+        if items is not None:
+            return items
+
+        items = list(concept_root.iterparse(fn))
+        for cr in items:
+            if not isinstance(cr, concept_root):
+                # the rules of ConceptTemplates are parsed on first access
+                cr.rules
+                continue
+            concepts = list(cr.concepts())
+            if len(cr.root.getElementsByTagNameNS("*","Applicability")):
+                concepts.append(cr.applicability())
+            for c in concepts:
+                try:
+                    c.template()
+                except Exception:
+                    # reported again when the template is used
+                    pass
+
+        file_cache.store_pickle(items, cache_fn)
+        return items
+
+    @staticmethod
+    def iterparse(fn):
+        from . import mvdxml_stream
+
+        templates, compiled, template_nodes = {}, {}, []
+        num_roots = 0
+
+        for event, node in mvdxml_stream.iterparse(fn, {"ConceptTemplate", "ConceptRoot"}):
+            if node.localName == "ConceptTemplate":
+                # registered on the start tag to preserve document order
+                if event == "start":
+                    template_nodes.append(node)
+                    if "uuid" in node.attributes:
+                        templates[node.getAttribute("uuid")] = node
+            elif node.localName == "ConceptRoot":
+                if event == "end":
+                    num_roots += 1
+                    yield concept_root(node.ownerDocument, node, templates, compiled)
+            elif num_roots == 0:
+                # end of document
+                for templ in template_nodes:
+                    yield template(None, templ, lazy=True)
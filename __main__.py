@@ -22,14 +22,17 @@ if __name__ == "__main__":
 
                 print()
 
-    elif len(sys.argv) == 3:
+    elif len(sys.argv) in (3, 4):
         from . import sparql
-        mvdfn,ttlfn = sys.argv[1:]
+        mvdfn,ttlfn = sys.argv[1:3]
+        engine_name = sys.argv[3] if len(sys.argv) == 4 else "jena"
         sparql.derive_prefix(ttlfn)
         ttlfn = sparql.infer_subtypes(ttlfn)
-        for mvd in concept_root.parse(mvdfn):
-            sparql.executor.run(mvd, mvdfn, ttlfn)
+        # the model is loaded once and queried for all concept roots
+        with sparql.engines[engine_name](ttlfn) as engine:
+            for mvd in concept_root.parse(mvdfn):
+                sparql.executor.run(mvd, mvdfn, ttlfn, engine)
             
     else:
         print(sys.executable, "ifcopenshell.mvd", "<.mvdxml>")
-        print(sys.executable, "ifcopenshell.mvd", "<.mvdxml>", "<.ifc>")
+        print(sys.executable, "ifcopenshell.mvd", "<.mvdxml>", "<.ifc>", "[jena|fuseki|rdflib]")
@@ -0,0 +1,76 @@
+import gc
+import os
+import sys
+import pickle
+import hashlib
+import contextlib
+
+def default_cache_dir():
+    """
+    Returns the directory of the cached files, $XDG_CACHE_HOME/ifcopenshell/mvd
+    or ~/.cache/ifcopenshell/mvd
+    """
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "ifcopenshell", "mvd")
+
+def file_digest(fn, *keys):
+    """
+    Returns the sha256 hex digest of the contents of a file followed by the
+    space separated keys, such as the versions the cached data depends on
+
+    :param fn: filename
+    :param keys: strings
+    """
+    h = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    h.update(" ".join(keys).encode())
+    return h.hexdigest()
+
+@contextlib.contextmanager
+def atomic_write(fn, mode="wb", **kwargs):
+    """
+    Opens a temporary file that replaces fn once it is written completely. On
+    error the temporary file is removed and fn is left untouched.
+    """
+    os.makedirs(os.path.dirname(fn) or ".", exist_ok=True)
+    tmp_fn = "%s.%d.tmp" % (fn, os.getpid())
+    try:
+        with open(tmp_fn, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_fn, fn)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+def load_pickle(fn):
+    """
+    Returns the object stored by store_pickle(), or None when the file does not
+    exist or cannot be loaded, for example when it is corrupt or written by
+    incompatible versions of the classes it contains
+    """
+    # the loaded objects are all reachable, collecting while loading is wasted effort
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(fn, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError,
+            TypeError, ValueError, KeyError, IndexError):
+        return None
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def store_pickle(obj, fn):
+    """
+    Stores obj in fn with atomic_write()
+    """
+    # nested structures are pickled recursively
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, 10000))
+    try:
+        with atomic_write(fn) as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+    finally:
+        sys.setrecursionlimit(limit)
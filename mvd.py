@@ -1,8 +1,15 @@
 import ifcopenshell
 import ifcopenshell.geom
 
+import io
 import os
+import ast
+import array
+import weakref
+import operator
 import itertools
+import collections.abc
+import multiprocessing
 
 import csv
 import xlsxwriter
@@ -106,6 +113,233 @@ def extract_data(mvd_node, ifc_data):
     return return_value
 
 
+# Default maximum number of attribute values kept by an attribute_cache
+ATTRIBUTE_CACHE_SIZE = 1 << 12
+
+attribute_cache_info = collections.namedtuple("attribute_cache_info", ["hits", "misses", "maxsize", "currsize"])
+
+
+class attribute_cache(object):
+    """
+    Bounded memo of attribute values of IFC instances, keyed by (instance id,
+    attribute name), so that inverse attributes such as IsDefinedBy and the
+    property sets and type objects shared by many occurrences are traversed
+    once. Only valid as long as the IFC file is not modified, a cache is
+    therefore created for every run. The least recently used values are
+    evicted when maxsize is exceeded. Hits and misses are counted per attribute.
+    """
+
+    def __init__(self, maxsize=ATTRIBUTE_CACHE_SIZE):
+        self.maxsize = maxsize
+        # (instance id, attribute) -> value, in order of last use
+        self.values = collections.OrderedDict()
+        # attribute -> [hits, misses]
+        self.stats = {}
+
+    def getter(self, attribute):
+        """
+        Returns a function that reads attribute from an IFC instance through the cache
+        """
+        values, maxsize = self.values, self.maxsize
+        stats = self.stats.setdefault(attribute, [0, 0])
+
+        def get(ifc_data):
+            # values such as IfcLabel('x') are not part of the file
+            if isinstance(ifc_data, ifcopenshell.entity_instance) and ifc_data.id():
+                key = ifc_data.id(), attribute
+                value = values.get(key, values)
+                if value is values:
+                    stats[1] += 1
+                    value = values[key] = getattr(ifc_data, attribute)
+                    if len(values) > maxsize:
+                        values.popitem(last=False)
+                else:
+                    stats[0] += 1
+                    values.move_to_end(key)
+                return value
+            return getattr(ifc_data, attribute)
+        return get
+
+    def info(self):
+        hits, misses = map(sum, zip((0, 0), *self.stats.values()))
+        return attribute_cache_info(hits, misses, self.maxsize, len(self.values))
+
+    def hit_rates(self):
+        """
+        Returns the fraction of lookups per attribute name that were served from the cache
+        """
+        return {attribute: hits / (hits + misses) for attribute, (hits, misses) in self.stats.items() if hits + misses}
+
+    def clear(self):
+        self.values.clear()
+        for counts in self.stats.values():
+            counts[:] = 0, 0
+
+
+def compile_rules(mvd_node, lazy=False, getters=None, cache=None):
+    """
+    Compiles an mvdXML Concept tree structure into a function that returns the
+    same data as extract_data(mvd_node, ifc_data). The tree is walked once, so
+    that tags, attribute names and constraint values are not re-interpreted
+    for every IFC instance.
+
+    :param mvd_node: an mvdXML Concept
+    :param lazy: When set to True, the function returns an iterator that yields
+        the combinations as they are requested, instead of a list. The data of
+        the child rules of an EntityRule is still collected, but their
+        cross product is never materialized.
+    :param getters: Optional mapping of AttributeRule nodes to functions that
+        take the IFC instance and return the attribute value, by default the
+        attribute is read with getattr().
+    :param cache: Optional attribute_cache used to read the attributes of the
+        other AttributeRule nodes that have child rules.
+    :return: function taking an IFC instance or an IFC value
+    """
+    attribute = mvd_node.attribute
+    collect = iter if lazy else list
+    get = (getters or {}).get(mvd_node)
+    if get is None:
+        # leaf attributes are read once per path, only traversals are cached
+        get = cache.getter(attribute) if cache is not None and mvd_node.nodes else operator.attrgetter(attribute)
+
+    if len(mvd_node.nodes) == 0:
+        if mvd_node.tag == "AttributeRule":
+            def extract(ifc_data):
+                try:
+                    return [{mvd_node: get(ifc_data)}]
+                except:
+                    return [{mvd_node: "Invalid Attribute"}]
+        else:
+            def extract(ifc_data):
+                return [{mvd_node: ifc_data}]
+        return extract
+
+    if mvd_node.tag == 'AttributeRule':
+        children = [compile_rules(child, lazy, getters, cache) for child in mvd_node.nodes]
+
+        def extract(ifc_data):
+            try:
+                values_from_attribute = get(ifc_data)
+                if values_from_attribute is None:
+                    return [{mvd_node: "Nonexistent value"}]
+            except:
+                return [{mvd_node: "Invalid attribute rule"}]
+
+            if isinstance(values_from_attribute, (list, tuple)):
+                if len(values_from_attribute) == 0:
+                    return [{mvd_node: 'empty data structure'}]
+            else:
+                values_from_attribute = (values_from_attribute,)
+
+            return collect(v for child in children for data in values_from_attribute for v in child(data))
+        return extract
+
+    elif mvd_node.tag == 'EntityRule':
+        # (constraint value, None) for Constraints, (None, function) for other rules
+        steps = []
+        for child in mvd_node.nodes:
+            if child.tag == "Constraint":
+                steps.append((child.attribute[0].c.replace("'", ""), None))
+            else:
+                steps.append((None, compile_rules(child, lazy, getters, cache)))
+
+        def extract(ifc_data):
+            is_instance = isinstance(ifc_data, ifcopenshell.entity_instance)
+            # Avoid things like Quantities on Psets
+            if is_instance and not ifc_data.is_a(attribute):
+                return []
+
+            to_combine = []
+            for on_node, child in steps:
+                if child is None:
+                    if is_instance:
+                        if ifc_data[0] == type(ifc_data[0])(on_node):
+                            return [{mvd_node: ifc_data}]
+                    elif ifc_data == on_node:
+                        return [{mvd_node: ifc_data}]
+                else:
+                    to_combine.append(child(ifc_data))
+
+            if len(to_combine) == 1:
+                # the dictionaries are freshly created, no need to merge copies
+                return to_combine[0]
+            elif len(to_combine):
+                return collect(map(merge_dictionaries, itertools.product(*to_combine)))
+            return []
+        return extract
+
+    return lambda ifc_data: []
+
+
+def compile_shared_rules(trees, cache=None):
+    """
+    Compiles several mvdXML Concept tree structures, typically of the Concepts
+    of a single ConceptRoot, into functions that share their reads. The trees are merged into a
+    trie on their paths of AttributeRules from the root, EntityRules do not
+    change the data passed to their children. Attributes on paths that occur
+    in more than one tree are read once per IFC instance and the values are
+    shared by all the trees.
+
+    :param trees: mvdXML Concept instance tree roots.
+    :param cache: Optional attribute_cache, see compile_rules().
+    :return: list of functions, one for every tree, taking an IFC instance and
+        returning the data extracted as by extract_data. The shared values are
+        kept until a function is called with another instance.
+    """
+    # (parent trie node, attribute) -> trie node, the root trie node is 0
+    trie = {}
+    # trie node -> set of indices of the trees passing through it
+    passing = collections.defaultdict(set)
+    nodes = []
+
+    def visit(mvd_node, trie_node, tree_index):
+        if mvd_node.tag == "AttributeRule":
+            key = (trie_node, mvd_node.attribute)
+            if key not in trie:
+                trie[key] = len(trie) + 1
+            trie_node = trie[key]
+            passing[trie_node].add(tree_index)
+            nodes.append((mvd_node, trie_node))
+        for child in mvd_node.nodes:
+            visit(child, trie_node, tree_index)
+
+    for i, tree in enumerate(trees):
+        visit(tree, 0, i)
+
+    # values read for the current root entity, (trie node, instance id) -> value
+    memo = {}
+    current = [None]
+
+    def shared_getter(trie_node, mvd_node):
+        attribute = mvd_node.attribute
+        read = cache.getter(attribute) if cache is not None and mvd_node.nodes else operator.attrgetter(attribute)
+
+        def get(ifc_data):
+            if isinstance(ifc_data, ifcopenshell.entity_instance) and ifc_data.id():
+                key = trie_node, ifc_data.id()
+                if key not in memo:
+                    memo[key] = read(ifc_data)
+                return memo[key]
+            return read(ifc_data)
+        return get
+
+    getters = {
+        mvd_node: shared_getter(trie_node, mvd_node)
+        for mvd_node, trie_node in nodes
+        if len(passing[trie_node]) > 1
+    }
+
+    def shared_extract(extract_tree):
+        def extract(ifc_data):
+            if current[0] is not ifc_data:
+                memo.clear()
+                current[0] = ifc_data
+            return extract_tree(ifc_data)
+        return extract
+
+    return [shared_extract(compile_rules(tree, getters=getters, cache=cache)) for tree in trees]
+
+
 def open_mvd(filename):
     """
     Open an mvdXML file.
@@ -156,7 +390,7 @@ def format_data_from_nodes(recurse_output):
         return []
 
 
-def get_data_from_mvd(entities, tree, filtering=False):
+def get_data_from_mvd(entities, tree, filtering=False, workers=1, cache=None):
     """
     Apply the recursive function on the entities to return
     the values extracted.
@@ -164,14 +398,23 @@ def get_data_from_mvd(entities, tree, filtering=False):
    :param entities: IFC instances to be processed.
    :param tree: mvdXML Concept instance tree root.
    :param filtering: Indicates whether the mvdXML tree is an applicability.
+   :param workers: Number of processes to distribute the entities over. Requires
+       the fork start method, so that the IFC file is shared with the workers,
+       otherwise entities are processed in the current process.
+   :param cache: attribute_cache used for the attribute values, a new one is
+       created when not given. Worker processes use caches of their own.
 
     """
+    if workers > 1 and len(entities) > 1 and "fork" in multiprocessing.get_all_start_methods():
+        return get_data_from_mvd_parallel(entities, tree, filtering, workers)
+
     filtered_entities = []
     extracted_entities_data = {}
+    extract = compile_rules(tree, cache=attribute_cache() if cache is None else cache)
 
     for entity in entities:
         entity_id = entity.GlobalId
-        combinations = extract_data(tree, entity)
+        combinations = extract(entity)
         desired_results = []
 
         for dictionary in combinations:
@@ -188,78 +431,294 @@ def get_data_from_mvd(entities, tree, filtering=False):
     return extracted_entities_data
 
 
+def get_data_from_mvd_shared(entities, trees, cache=None):
+    """
+    Apply several mvdXML Concept trees on the entities, visiting every entity
+    once. Attributes on paths shared by the trees are read once per entity,
+    see compile_shared_rules().
+
+    :param entities: IFC instances to be processed.
+    :param trees: mvdXML Concept instance tree roots.
+    :param cache: attribute_cache, a new one is created when not given.
+    :return: list of dictionaries, as by get_data_from_mvd(), one for every tree
+
+    """
+    extracted_data = [{} for tree in trees]
+
+    for entity, outputs in iter_data_from_mvd(entities, trees, cache=cache):
+        entity_id = entity.GlobalId
+        for output, extracted_entities_data in zip(outputs, extracted_data):
+            extracted_entities_data[entity_id] = output
+
+    return extracted_data
+
+
+def iter_data_from_mvd(entities, trees, filters=(), cache=None):
+    """
+    Apply mvdXML Concept trees on the entities one at a time, yielding the
+    values as soon as an entity is processed, so that nothing is retained
+    between entities.
+
+    :param entities: IFC instances to be processed.
+    :param trees: mvdXML Concept instance tree roots.
+    :param filters: mvdXML applicability tree roots. An entity is skipped as
+        soon as one of them returns no value, as in get_data().
+    :param cache: attribute_cache, a new one is created when not given.
+    :return: generator of (entity, outputs) tuples, the outputs of the filters
+        followed by the outputs of the trees, as by get_data_from_mvd()
+
+    """
+    filters, trees = list(filters), list(trees)
+    extractors = compile_shared_rules(filters + trees, cache=attribute_cache() if cache is None else cache)
+
+    for entity in entities:
+        outputs = extract_outputs(extractors, len(filters), entity)
+        if outputs is not None:
+            yield entity, outputs
+
+
+def extract_outputs(extractors, num_filters, entity):
+    """
+    Returns the formatted outputs of the extractors on the entity, or None when
+    one of the first num_filters, the applicability, returns no value.
+    """
+    outputs = []
+    for i, extract in enumerate(extractors):
+        output = format_data_from_nodes(list(extract(entity)))
+        if i < num_filters and not len(output):
+            return None
+        outputs.append(output)
+    return outputs
+
+
+class run_plan(object):
+    """
+    Groups ConceptRoots by their applicableRootEntity, taking subtypes into
+    account, so that an IFC file is traversed once for all of them. Only the
+    most general entity types are retrieved from the file and every instance
+    is dispatched to all the entity types it is an instance of. Entity types
+    that are not part of the schema of the file have no instances.
+
+    :param concept_roots: mvdXML ConceptRoot instances.
+    :param ifc_file: IFC file from any schema.
+    """
+
+    def __init__(self, concept_roots, ifc_file):
+        self.ifc_file = ifc_file
+        self.schema = ifcopenshell.ifcopenshell_wrapper.schema_by_name(ifc_file.schema)
+        # entity type -> ConceptRoots, in order of first occurrence
+        self.roots_by_type = {}
+        for cr in concept_roots:
+            self.roots_by_type.setdefault(cr.entity, []).append(cr)
+        # instance type -> entity types of the ConceptRoots
+        self.dispatch = {}
+
+    def supertypes(self, entity_type):
+        """
+        Returns the upper case names of the entity type and its supertypes,
+        an empty set when it is not an entity of the schema
+        """
+        try:
+            declaration = self.schema.declaration_by_name(entity_type).as_entity()
+        except RuntimeError:
+            declaration = None
+        names = set()
+        while declaration is not None:
+            names.add(declaration.name().upper())
+            declaration = declaration.supertype()
+        return names
+
+    def matching_types(self, instance_type):
+        """
+        Returns the entity types of the ConceptRoots that apply to instances of instance_type
+        """
+        if instance_type not in self.dispatch:
+            names = self.supertypes(instance_type)
+            self.dispatch[instance_type] = [t for t in self.roots_by_type if t.upper() in names]
+        return self.dispatch[instance_type]
+
+    def scanned_types(self):
+        """
+        Returns the entity types that are retrieved from the file, the ones that
+        are not a subtype of another entity type of the ConceptRoots
+        """
+        types = {t.upper() for t in self.roots_by_type}
+        scanned = {}
+        for t in self.roots_by_type:
+            supertypes = self.supertypes(t) - {t.upper()}
+            if self.supertypes(t) and not supertypes & types:
+                scanned.setdefault(t.upper(), t)
+        return list(scanned.values())
+
+    def instances(self):
+        """
+        Yields (instance, entity types) tuples, every instance of the entity
+        types of the ConceptRoots once, with the entity types that apply to it
+        """
+        for t in self.scanned_types():
+            for entity in self.ifc_file.by_type(t):
+                yield entity, self.matching_types(entity.is_a())
+
+
+def iter_data_from_roots(concept_roots, ifc_file, cache=None):
+    """
+    Like iter_data_from_mvd() for all Concepts of several ConceptRoots, with
+    a single pass over the IFC file, see run_plan.
+
+    :param concept_roots: mvdXML ConceptRoot instances.
+    :param ifc_file: IFC file from any schema.
+    :param cache: attribute_cache, a new one is created when not given.
+    :return: generator of (ConceptRoot, entity, outputs) tuples, the outputs
+        in the order of the spreadsheet columns of get_data()
+    """
+    plan = run_plan(concept_roots, ifc_file)
+
+    # ConceptRoot -> (number of applicability trees, range of its extractors)
+    trees, ranges = [], {}
+    for roots in plan.roots_by_type.values():
+        for cr in roots:
+            concepts = sorted(cr.concepts(), key=is_applicability, reverse=True)
+            start = len(trees)
+            trees.extend(get_rules_root(concept, cr.entity) for concept in concepts)
+            ranges[cr] = (sum(map(is_applicability, concepts)), slice(start, len(trees)))
+
+    extractors = compile_shared_rules(trees, cache=attribute_cache() if cache is None else cache)
+
+    for entity, entity_types in plan.instances():
+        for entity_type in entity_types:
+            for cr in plan.roots_by_type[entity_type]:
+                num_filters, extractors_range = ranges[cr]
+                outputs = extract_outputs(extractors[extractors_range], num_filters, entity)
+                if outputs is not None:
+                    yield cr, entity, outputs
+
+
+class instance_reference(object):
+    """
+    Picklable stand-in for an IFC instance or IFC value, used to send
+    extracted data from worker processes back to the parent.
+    """
+
+    def __init__(self, inst):
+        self.id = inst.id()
+        if self.id == 0:
+            # values such as IfcBoolean(.T.) are not part of the file
+            self.type, self.value = inst.is_a(), pack_data(inst.wrappedValue)
+
+    def resolve(self, ifc_file):
+        if self.id:
+            return ifc_file.by_id(self.id)
+        return ifcopenshell.create_entity(self.type, ifc_file.schema, unpack_data(ifc_file, self.value))
+
+
+def pack_data(v):
+    if isinstance(v, ifcopenshell.entity_instance):
+        return instance_reference(v)
+    elif isinstance(v, (list, tuple)):
+        return type(v)(map(pack_data, v))
+    return v
+
+
+def unpack_data(ifc_file, v):
+    if isinstance(v, instance_reference):
+        return v.resolve(ifc_file)
+    elif isinstance(v, (list, tuple)):
+        return type(v)(unpack_data(ifc_file, x) for x in v)
+    return v
+
+
+# Entities and tree shared with forked worker processes
+worker_state = {}
+
+
+def get_data_from_mvd_worker(chunk):
+    entities = worker_state["entities"][chunk[0]:chunk[1]]
+    extracted_entities_data = get_data_from_mvd(entities, worker_state["tree"], filtering=worker_state["filtering"])
+    return [(k, pack_data(v)) for k, v in extracted_entities_data.items()]
+
+
+def get_data_from_mvd_parallel(entities, tree, filtering, workers):
+    """
+    Shards the entities in contiguous chunks over a pool of forked processes.
+    Results are merged in chunk order, so the outcome is identical to
+    get_data_from_mvd() in a single process.
+    """
+    ifc_file = entities[0].file
+    num_chunks = min(len(entities), workers * 4)
+    bounds = [len(entities) * i // num_chunks for i in range(num_chunks + 1)]
+
+    worker_state.update(entities=entities, tree=tree, filtering=filtering)
+    try:
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            extracted_entities_data = {}
+            for chunk_data in pool.imap(get_data_from_mvd_worker, zip(bounds, bounds[1:])):
+                for k, v in chunk_data:
+                    extracted_entities_data[k] = unpack_data(ifc_file, v)
+    finally:
+        worker_state.clear()
+
+    return extracted_entities_data
+
+
+def format_for_export(v):
+    """
+    Process a single extracted value for spreadsheet export.
+    """
+    if isinstance(v, list) or isinstance(v, tuple):
+        if len(v):
+            return ','.join(str(data) for data in v)
+        return 0
+
+    elif isinstance(v, ifcopenshell.entity_instance):
+        if g := getattr(v, 'GlobalId', None):
+            return g
+        return str(v)
+    return v
+
+
 def correct_for_export(all_data):
     """
     Process the data for spreadsheet export.
     """
     for d in all_data:
         for k, v in d.items():
-            if isinstance(v, list) or isinstance(v, tuple):
-                if len(v):
-                    new_list = []
-                    for data in v:
-                        new_list.append(str(data))
-                    d[k] = ','.join(new_list)
-                if len(v) == 0:
-                    d[k] = 0
-
-            elif isinstance(v, ifcopenshell.entity_instance):
-                if g := getattr(v, 'GlobalId', None):
-                    d[k] = g
-                else:
-                    d[k] = str(v)
+            d[k] = format_for_export(v)
     return all_data
 
 
-def export_to_xlsx(xlsx_name, concepts, all_data):
+# Directory to which spreadsheets are exported by default
+OUTPUT_DIR = "spreadsheet_output/"
+
+
+def export_to_xlsx(xlsx_name, concepts, all_data, output_dir=OUTPUT_DIR):
     """
     Export data towards XLSX spreadsheet format.
 
     :param xlsx_name: Name of the outputted file.
     :param concepts: List of mvdXML Concept instances.
     :param all_data: Data extracted.
+    :param output_dir: Directory in which the file is created.
 
     """
-    
-    if not os.path.isdir("spreadsheet_output/"):
-        os.mkdir("spreadsheet_output/")
-        
-    workbook = xlsxwriter.Workbook("spreadsheet_output/" + xlsx_name)
-    worksheet = workbook.add_worksheet()
-    # Formats
-    bold_format = workbook.add_format()
-    bold_format.set_bold()
-    bold_format.set_center_across()
-    # Write first row
-    column_index = 0
-    for concept in concepts:
-        worksheet.write(0, column_index, concept.name, bold_format)
-        column_index += 1
-
-    col = 0
-    for feature in all_data:
-        row = 1
-        for d in feature.values():
-            worksheet.write(row, col, d)
-            row += 1
-        col += 1
+    with xlsx_export(xlsx_name, concepts, output_dir) as export:
+        # the workbook is written row by row, missing cells are left blank
+        for row in itertools.zip_longest(*(feature.values() for feature in all_data)):
+            export.write(row)
 
-    workbook.close()
 
-
-def export_to_csv(csv_name, concepts, all_data):
+def export_to_csv(csv_name, concepts, all_data, output_dir=OUTPUT_DIR):
     """
     Export data towards CSV spreadsheet format.
 
     :param csv_name: Name of the file outputted file.
     :param concepts: List of mvdXML Concept instances.
     :param all_data: Data extracted.
+    :param output_dir: Directory in which the file is created.
     """
     
-    if not os.path.isdir("spreadsheet_output/"):
-        os.mkdir("spreadsheet_output/")
+    os.makedirs(output_dir, exist_ok=True)
         
-    with open('spreadsheet_output/' + csv_name, 'w', newline='') as f:
+    with open(os.path.join(output_dir, csv_name), 'w', newline='') as f:
         writer = csv.writer(f)
         header = [concept.name for concept in concepts]
         first_row = writer.writerow(header)
@@ -276,7 +735,265 @@ def export_to_csv(csv_name, concepts, all_data):
             f = writer.writerow(row_to_write)
 
 
-def get_data(mvd_concept, ifc_file, spreadsheet_export=True):
+class csv_export(object):
+    """
+    CSV spreadsheet writer to which rows are written as they are extracted.
+
+    :param csv_name: Name of the outputted file.
+    :param concepts: List of mvdXML Concept instances, one column each.
+    :param output_dir: Directory in which the file is created.
+    """
+
+    def __init__(self, csv_name, concepts, output_dir=OUTPUT_DIR):
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.file = open(os.path.join(output_dir, csv_name), 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([concept.name for concept in concepts])
+
+    def write(self, values):
+        self.writer.writerow([format_for_export(v) for v in values])
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class xlsx_export(object):
+    """
+    XLSX spreadsheet writer to which rows are written as they are extracted.
+    The workbook uses the constant memory mode of xlsxwriter, every row is
+    flushed to disk when the next one is written.
+
+    :param xlsx_name: Name of the outputted file.
+    :param concepts: List of mvdXML Concept instances, one column each.
+    :param output_dir: Directory in which the file is created.
+    """
+
+    def __init__(self, xlsx_name, concepts, output_dir=OUTPUT_DIR):
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.workbook = xlsxwriter.Workbook(os.path.join(output_dir, xlsx_name), {'constant_memory': True})
+        self.worksheet = self.workbook.add_worksheet()
+        # Formats
+        bold_format = self.workbook.add_format()
+        bold_format.set_bold()
+        bold_format.set_center_across()
+        # Write first row
+        for column_index, concept in enumerate(concepts):
+            self.worksheet.write(0, column_index, concept.name, bold_format)
+        self.row = 1
+
+    def write(self, values):
+        for column_index, v in enumerate(values):
+            if v is not None:
+                self.worksheet.write(self.row, column_index, format_for_export(v))
+        self.row += 1
+
+    def close(self):
+        self.workbook.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Spreadsheet writers by file extension
+export_formats = {".csv": csv_export, ".xlsx": xlsx_export}
+
+
+def get_rules_root(concept, entity):
+    """
+    Returns the root of the rules of the ConceptTemplate of a Concept, combined
+    in an EntityRule when the template has several rules.
+    """
+    rules = concept.template().rules
+    if len(rules) > 1:
+        return ifcopenshell.mvd.rule("EntityRule", entity, rules)
+    return rules[0]
+
+
+def export_data(mvd_concept, ifc_file, export_names, output_dir=OUTPUT_DIR, cache=None):
+    """
+    Extracts the data queried by the mvdXML ConceptRoot and writes it to
+    spreadsheets entity by entity, without keeping the extracted data in memory.
+    The columns are the same as for the spreadsheet export of get_data(), one
+    row is written for every entity that passes the applicability Concepts.
+
+    :param mvd_concept: mvdXML Concept instance.
+    :param ifc_file: IFC file from any schema.
+    :param export_names: Names of the outputted files, the format is chosen
+        by their extension, see export_formats.
+    :param output_dir: Directory in which the files are created.
+    :param cache: attribute_cache, a new one is created when not given.
+    :return: Number of rows written.
+    """
+    concepts = sorted(mvd_concept.concepts(), key=is_applicability, reverse=True)
+    filters = [get_rules_root(concept, mvd_concept.entity) for concept in concepts if is_applicability(concept)]
+    trees = [get_rules_root(concept, mvd_concept.entity) for concept in concepts if not is_applicability(concept)]
+
+    exports = []
+    rows = 0
+    try:
+        for export_name in export_names:
+            export_format = os.path.splitext(export_name)[1].lower()
+            if export_format not in export_formats:
+                raise ValueError(f"Unsupported spreadsheet format {export_name}")
+            exports.append(export_formats[export_format](export_name, concepts, output_dir))
+
+        for entity, outputs in iter_data_from_mvd(ifc_file.by_type(mvd_concept.entity), trees, filters, cache):
+            for export in exports:
+                export.write(outputs)
+            rows += 1
+    finally:
+        for export in exports:
+            export.close()
+    return rows
+
+
+def export_data_to_csv(mvd_concept, ifc_file, csv_name, cache=None, output_dir=OUTPUT_DIR):
+    """
+    Streaming CSV export of a single file, see export_data().
+    """
+    return export_data(mvd_concept, ifc_file, [csv_name], output_dir, cache)
+
+
+class columnar_data(object):
+    """
+    Extracted data stored per column, with a GlobalId column and for every
+    Concept an int32 column of codes into the distinct values of that column,
+    stored as UTF-8 encoded strings, -1 where the entity has no value. Written as a directory with the
+    rows in a structured array, which can be memory-mapped when read back, and
+    the distinct values of the columns.
+
+    :param concepts: Concept names, one for every column.
+    :param rows: numpy structured array with a GlobalId field and fields c0, c1,
+        ... holding the codes of the columns.
+    :param categories: numpy bytes arrays of the distinct values of every column.
+    """
+
+    def __init__(self, concepts, rows, categories):
+        self.concepts, self.rows, self.categories = list(concepts), rows, list(categories)
+
+    @staticmethod
+    def from_data(concepts, all_data):
+        """
+        :param concepts: Concept names, one for every dictionary in all_data.
+        :param all_data: Data extracted and corrected for export, as returned by get_data().
+        """
+        import numpy
+
+        global_ids = list(dict.fromkeys(itertools.chain.from_iterable(all_data)))
+        rows = numpy.zeros(len(global_ids), dtype=[("GlobalId", "S22")] + [("c%d" % i, "i4") for i in range(len(all_data))])
+        rows["GlobalId"] = global_ids
+
+        categories = []
+        for i, d in enumerate(all_data):
+            # distinct value -> code, in order of first occurrence
+            values = {}
+            rows["c%d" % i] = [values.setdefault(str(d[global_id]).encode("utf-8"), len(values)) if global_id in d else -1
+                               for global_id in global_ids]
+            categories.append(numpy.array(list(values), dtype=bytes))
+
+        return columnar_data(concepts, rows, categories)
+
+    @staticmethod
+    def read(path, mmap_mode="r"):
+        """
+        :param path: Directory written by write().
+        :param mmap_mode: Passed to numpy.load() for the rows, None to read them in memory.
+        """
+        import numpy
+
+        rows = numpy.load(os.path.join(path, "rows.npy"), mmap_mode=mmap_mode)
+        with numpy.load(os.path.join(path, "categories.npz")) as f:
+            concepts = list(f["concepts"])
+            categories = [f["c%d" % i] for i in range(len(concepts))]
+        return columnar_data(concepts, rows, categories)
+
+    def write(self, path):
+        import numpy
+
+        os.makedirs(path, exist_ok=True)
+        numpy.save(os.path.join(path, "rows.npy"), self.rows)
+        numpy.savez(os.path.join(path, "categories.npz"), concepts=numpy.array(self.concepts, dtype=str),
+                    **{"c%d" % i: c for i, c in enumerate(self.categories)})
+
+    @property
+    def global_ids(self):
+        return self.rows["GlobalId"]
+
+    def codes(self, concept):
+        return self.rows["c%d" % self.concepts.index(concept)]
+
+    def column(self, concept):
+        """
+        Returns the values of a column as strings, None where the entity has no value
+        """
+        i = self.concepts.index(concept)
+        categories = self.categories[i]
+        return [categories[code].decode("utf-8") if code >= 0 else None for code in self.rows["c%d" % i]]
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def get_columnar_data(mvd_concept, ifc_file, workers=1, cache=None):
+    """
+    Returns the data queried by the mvdXML ConceptRoot as columnar_data, with
+    the columns in the order of the spreadsheet export of get_data().
+
+    :param mvd_concept: mvdXML Concept instance.
+    :param ifc_file: IFC file from any schema.
+    :param workers: Number of processes used for extraction, see get_data_from_mvd().
+    :param cache: attribute_cache, see get_data().
+    """
+    concepts = sorted(mvd_concept.concepts(), key=is_applicability, reverse=True)
+    all_data, verification = get_data(mvd_concept, ifc_file, spreadsheet_export=False, workers=workers, cache=cache)
+    return columnar_data.from_data([concept.name for concept in concepts], all_data)
+
+
+class verification_matrix(collections.abc.Mapping):
+    """
+    Records for every applicability Concept which of the root entities do not
+    respect it, as one bit per entity. Reads as a mapping of GlobalId to a
+    mapping of Concept name to 1 (not respecting) or 0.
+    """
+
+    def __init__(self, entities):
+        self.index = {entity.GlobalId: i for i, entity in enumerate(entities)}
+        self.size = len(entities)
+        self.columns = {}
+
+    def set_column(self, concept_name, not_respecting):
+        """
+        :param concept_name: Name of the applicability Concept.
+        :param not_respecting: Indices of the entities that do not respect it.
+        """
+        bits = bytearray((self.size + 7) // 8)
+        for i in not_respecting:
+            bits[i >> 3] |= 1 << (i & 7)
+        self.columns[concept_name] = bits
+
+    def __getitem__(self, global_id):
+        i = self.index[global_id]
+        return {name: (bits[i >> 3] >> (i & 7)) & 1 for name, bits in self.columns.items()}
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def get_data(mvd_concept, ifc_file, spreadsheet_export=True, workers=1, cache=None, output_dir=OUTPUT_DIR):
     """
     Use the majority of all the other functions to return the data
     queried by the mvdXML file in python format.
@@ -284,6 +1001,10 @@ def get_data(mvd_concept, ifc_file, spreadsheet_export=True):
     :param mvd_concept: mvdXML Concept instance.
     :param ifc_file: IFC file from any schema.
     :param spreadsheet_export: The spreadsheet export is carried out when set to True.
+    :param workers: Number of processes used for extraction, see get_data_from_mvd().
+    :param cache: attribute_cache shared by all Concepts, a new one is created
+        when not given. Pass one to inspect its hit rates afterwards.
+    :param output_dir: Directory in which the spreadsheets are exported.
 
 
 
@@ -292,17 +1013,17 @@ def get_data(mvd_concept, ifc_file, spreadsheet_export=True):
     # Check if IFC entities have been filtered at least once
     filtered = 0
 
+    if cache is None:
+        cache = attribute_cache()
+
     entities = ifc_file.by_type(mvd_concept.entity)
     selected_entities = entities
-    verification_matrix = {}
-    for entity in selected_entities:
-        verification = dict()
-        verification_matrix[entity.GlobalId] = verification
+    verification = verification_matrix(entities)
 
     # For each Concept(ConceptTemplate) in the ConceptRoot
     concepts = sorted(mvd_concept.concepts(), key=is_applicability, reverse=True)
     all_data = []
-    counter = 0
+    trees = []
     for concept in concepts:
         if is_applicability(concept):
             filtering = True
@@ -310,34 +1031,26 @@ def get_data(mvd_concept, ifc_file, spreadsheet_export=True):
             filtering = False
 
         # Access all the Rules of the ConceptTemplate
-        if len(concept.template().rules) > 1:
-            attribute_rules = []
-            for rule in concept.template().rules:
-                attribute_rules.append(rule)
-            rules_root = ifcopenshell.mvd.rule("EntityRule", mvd_concept.entity, attribute_rules)
-        else:
-            rules_root = concept.template().rules[0]
+        rules_root = get_rules_root(concept, mvd_concept.entity)
+
 
+        if not filtering and workers <= 1:
+            # extracted below in a single pass over the selected entities
+            trees.append(rules_root)
+            continue
 
-        extracted_data = get_data_from_mvd(selected_entities, rules_root, filtering=filtering)
+        extracted_data = get_data_from_mvd(selected_entities, rules_root, filtering=filtering, workers=workers, cache=cache)
         all_data.append(extracted_data)
 
         if filtering:
             filtered = 1
-            new_entities = []
-            for entity_id in all_data[counter].keys():
-                if len(all_data[counter][entity_id]) != 0:
-                    entity = ifc_file.by_id(entity_id)
-                    new_entities.append(entity)
-
-            selected_entities = new_entities
-            not_respecting_entities = [item for item in entities if item not in selected_entities]
-            for entity in entities:
-                val = 0
-                if entity in not_respecting_entities:
-                    val = 1
-                verification_matrix[entity.GlobalId].update({concept.name: val})
-        counter += 1
+            passing = {entity_id for entity_id, output in extracted_data.items() if len(output) != 0}
+            selected_entities = [entity for entity in selected_entities if entity.GlobalId in passing]
+            selected_ids = {entity.id() for entity in selected_entities}
+            verification.set_column(concept.name, (i for i, entity in enumerate(entities) if entity.id() not in selected_ids))
+
+    # applicability concepts come first, the other concepts share their paths
+    all_data.extend(get_data_from_mvd_shared(selected_entities, trees, cache=cache))
 
     all_data = correct_for_export(all_data)
 
@@ -346,11 +1059,11 @@ def get_data(mvd_concept, ifc_file, spreadsheet_export=True):
             export_name = "output_filtered"
         else:
             export_name = "output_non_filtered"
-        export_to_xlsx(export_name + '.xlsx', concepts, all_data)
-        export_to_csv(export_name + '.csv', concepts, all_data)
+        export_to_xlsx(export_name + '.xlsx', concepts, all_data, output_dir)
+        export_to_csv(export_name + '.csv', concepts, all_data, output_dir)
 
 
-    return all_data, verification_matrix
+    return all_data, verification
 
 
 def get_non_respecting_entities(file, verification_matrix):
@@ -421,79 +1134,326 @@ def visualize(file, not_respecting_entities):
     ifcopenshell.geom.utils.main_loop()
 
 
-def validate_data(concept, data):
-    import io
-    import ast
-    import operator
-    from functools import reduce, partial
+class lazy_list(object):
+    """
+    Re-iterable sequence over an iterator, which is only advanced as far as
+    any of the iterations so far required.
+    """
+
+    def __init__(self, iterable):
+        self.iterator, self.items = iter(iterable), []
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i == len(self.items):
+                try:
+                    self.items.append(next(self.iterator))
+                except StopIteration:
+                    return
+            yield self.items[i]
+            i += 1
+
+
+def transform_data(d):
+    """
+    Transform dictionary keys from tree nodes to rule ids
+    """
+
+    return {(k.parent if k.bind is None and (k.parent is not None and k.parent.bind is not None) else k).bind: v for k, v in d.items()}
+
+
+def parse_mvdxml_token(v):
+    if v.lower() == "true":
+        return True
+    if v.lower() == "false":
+        return False
+    # @todo make more permissive and tolerant
+    return ast.literal_eval(v)
+
 
+def compile_predicate(v):
+    """
+    Compiles a single mvdXML expression node into a function evaluated on a
+    row of data as returned by transform_data.
+
+    :param v: mvdxml_expression.node instance
+    :return: function taking a dictionary of rule ids to values
+    """
+    a = v.a
+    try:
+        value = parse_mvdxml_token(v.c)
+        constant = lambda: value
+    except Exception:
+        # An invalid constant is only reported when the predicate is evaluated
+        constant = lambda: parse_mvdxml_token(v.c)
+
+    if v.b == "Value" or v.b is None:
+        return lambda d: d.get(a) == constant()
+    elif v.b == "Type":
+        return lambda d: d.get(a) is not None and d.get(a).is_a(constant())
+    elif v.b == "Exists":
+        return lambda d: (d.get(a) is not None) == constant()
+    else:
+        def invalid(d):
+            raise RuntimeError(f"Invalid rule predicate {v.b}")
+        return invalid
+
+
+def compile_rule(r):
+    """
+    Compiles a TemplateRule, a sequence of alternating expression nodes and
+    boolean operators applied from left to right, into a predicate on a row of
+    data. The right hand side of AND and OR is only evaluated when needed.
+
+    :param r: parsed TemplateRule Parameters
+    :return: function taking a dictionary of rule ids to values
+    """
+    first = compile_predicate(r[0])
+    rest = [(getattr(operator, op.lower() + "_"), compile_predicate(v)) for op, v in zip(r[1::2], r[2::2])]
+
+    def evaluate(d):
+        value = first(d)
+        for op, predicate in rest:
+            if op is operator.and_ and not value:
+                continue
+            if op is operator.or_ and value:
+                continue
+            value = op(value, predicate(d))
+        return value
+    return evaluate
+
+
+def compile_validator(concept):
+    """
+    Compiles the TemplateRules of a concept once, into a function that validates
+    extracted data. A rule is met when any of the combinations satisfies it, data
+    is only consumed until that is the case, so it can be supplied lazily from
+    compile_rules(..., lazy=True).
+
+    :param concept: mvdXML Concept instance.
+    :return: function taking an iterable of combinations as returned by extract_data
+        and returning a tuple of validity and a list of (TemplateRule, met) tuples.
+    """
     rules = [x[0] for x in concept.rules() if not isinstance(x, str)]
-    
-    def transform_data(d):
-        """
-        Transform dictionary keys from tree nodes to rule ids
-        """
-        
-        return {(k.parent if k.bind is None and (k.parent is not None and k.parent.bind is not None) else k).bind: v for k, v in d.items()}
+    compiled = [(r, compile_rule(r)) for r in rules]
 
-    
-    def parse_mvdxml_token(v):
-        if v.lower() == "true":
-            return True
-        if v.lower() == "false":
-            return False
-        # @todo make more permissive and tolerant
-        return ast.literal_eval(v)
+    def validate(data):
+        data = lazy_list(map(transform_data, data))
+        results = [(r, any(map(evaluate, data))) for r, evaluate in compiled]
+        return all(met for r, met in results), results
+    return validate
 
 
-    data = list(map(transform_data, data))
-    
+# Compiled validators by concept
+validators = weakref.WeakKeyDictionary()
+
+
+def validate_data(concept, data):
+    """
+    Validates extracted data against the TemplateRules of the concept, see
+    compile_validator().
+
+    :param concept: mvdXML Concept instance.
+    :param data: iterable of combinations as returned by extract_data.
+    :return: tuple of validity and a textual report of the rules.
+    """
+    if concept not in validators:
+        validators[concept] = compile_validator(concept)
+
+    valid, results = validators[concept](data)
+
     output = io.StringIO()
-        
-    # https://stackoverflow.com/a/70227259
-    def operation_reduce(x, y):
+    for r, met in results:
+        print(("Met:" if met else "Not met:"), r, file=output)
+
+    return valid, output.getvalue()
+
+
+# Cell values of a validation_result
+FAIL, PASS, ERROR, NOT_APPLICABLE = 0, 1, 2, 3
+
+
+class validation_result(object):
+    """
+    Columnar outcome of validate_file(). Rows are entity instance ids, columns
+    are (ConceptRoot, Concept) pairs. Every cell is a single byte holding PASS,
+    FAIL, ERROR or NOT_APPLICABLE, when the entity is not of the type of the
+    ConceptRoot or does not meet its applicability.
+    """
+
+    def __init__(self, entity_ids, concepts):
+        self.entity_ids = array.array('q', entity_ids)
+        self.concepts = concepts
+        self.columns = [bytearray([NOT_APPLICABLE]) * len(self.entity_ids) for c in concepts]
+        # Per column, error message -> number of cells
+        self.errors = [collections.Counter() for c in concepts]
+        self.row_index = {entity_id: i for i, entity_id in enumerate(self.entity_ids)}
+
+    def set_error(self, row, column, exception):
+        self.columns[column][row] = ERROR
+        self.errors[column][f"{type(exception).__name__}: {exception}"] += 1
+
+    def status(self, entity_id, column):
+        return self.columns[column][self.row_index[entity_id]]
+
+    def rows(self):
         """
-        Takes alternating value and function as input and
-        reduces while applying function
+        Yields tuples of an entity instance id and the cell values for all columns
         """
-        
-        if callable(x):
-            return x(y)
-        else:
-            return partial(y, x)
-            
-            
-    def apply_rules():
-    
-        for r in rules:
-        
-            def apply_data():
-            
-                for d in data:
-                                
-                    def translate(v):
-                        if isinstance(v, str):
-                            return getattr(operator, v.lower() + "_")
-                        else:
-                            if v.b == "Value" or v.b is None:
-                                return d.get(v.a) == parse_mvdxml_token(v.c)
-                            elif v.b == "Type":
-                                return d.get(v.a) is not None and d.get(v.a).is_a(parse_mvdxml_token(v.c))
-                            elif v.b == "Exists":
-                                return (d.get(v.a) is not None) == parse_mvdxml_token(v.c)
-                            else:
-                                raise RuntimeError(f"Invalid rule predicate {v.b}")
-                            
-                    r2 = list(map(translate, r))
-                    yield reduce(operation_reduce, r2)
-                
-            v = any(list(apply_data()))
-            print(("Met:" if v else "Not met:"), r, file=output)
-            yield v
-
-
-    valid = all(list(apply_rules()))
-    return valid, output.getvalue()
+        for i, entity_id in enumerate(self.entity_ids):
+            yield entity_id, [column[i] for column in self.columns]
+
+    def summary(self):
+        """
+        Returns for every column the ConceptRoot, Concept and number of cells per value
+        """
+        return [(cr, c, collections.Counter(column)) for (cr, c), column in zip(self.concepts, self.columns)]
+
+
+def validate_file(concept_roots, ifc_file, cache=None):
+    """
+    Validates all Concepts of the ConceptRoots on the applicable instances of
+    their applicable root entity, in a single pass over the IFC file, see run_plan.
+    An instance is applicable when it meets the TemplateRules of the
+    Applicability of the ConceptRoot, as in the SPARQL executor, and returns
+    values for its filtering Concepts, see is_applicability() and get_data().
+    Filtering Concepts are not validated themselves. Concepts that share their
+    rules, because they use the same ConceptTemplate, share a single extraction
+    per entity, attributes on paths shared by different rules are read once
+    per entity.
+
+    :param concept_roots: mvdXML ConceptRoot instances.
+    :param ifc_file: IFC file from any schema.
+    :param cache: attribute_cache shared by all entity types, a new one is
+        created when not given.
+    :return: validation_result instance.
+    """
+    if cache is None:
+        cache = attribute_cache()
+
+    concept_roots = list(concept_roots)
+    concepts = [(cr, c) for cr in concept_roots for c in cr.concepts() if not is_applicability(c)]
+
+    columns_by_type = {}
+    for column, (cr, c) in enumerate(concepts):
+        columns_by_type.setdefault(cr.entity, []).append(column)
+
+    # ConceptRoots without Concepts have no columns, their instances are not visited
+    roots_with_columns = [cr for cr in concept_roots if any(root is cr for root, c in concepts)]
+    plan = run_plan(roots_with_columns, ifc_file)
+    instances = list(plan.instances())
+    result = validation_result(dict.fromkeys(entity.id() for entity, entity_types in instances), concepts)
+
+    trees = []
+    # (entity type, rule node ids) -> extractor index
+    tree_index = {}
+
+    def add_tree(concept, entity_type):
+        rules_root = get_rules_root(concept, entity_type)
+        # Concepts of the same template share the compiled rules
+        key = (entity_type,) + tuple(map(id, concept.template().rules))
+        if key not in tree_index:
+            tree_index[key] = len(trees)
+            trees.append(rules_root)
+        return tree_index[key]
+
+    # ConceptRoot -> [(extractor index, validator)], the validator is None for
+    # filtering Concepts, which only need to return values, the index is None
+    # for an Applicability without rules
+    filters_by_root = {}
+    # ConceptRoot -> exception of an applicability that cannot be evaluated
+    filter_errors = {}
+    for cr in roots_with_columns:
+        filters = filters_by_root[cr] = []
+        try:
+            try:
+                applicability = cr.applicability()
+            except IndexError:
+                # without Applicability all instances are applicable
+                applicability = None
+            if applicability is not None:
+                # a template without rules extracts nothing, only the TemplateRules apply
+                index = add_tree(applicability, cr.entity) if applicability.template().rules else None
+                filters.append((index, compile_validator(applicability)))
+            for c in cr.concepts():
+                if is_applicability(c):
+                    filters.append((add_tree(c, cr.entity), None))
+        except Exception as e:
+            filter_errors[cr] = e
+
+    # entity type -> [(extractor index, [(column, validator)])]
+    extractions_by_type = {}
+    # entity type -> [(column, exception)] of the Concepts that cannot be validated
+    errors_by_type = {}
+    for entity_type, columns in columns_by_type.items():
+        # extractor index -> [(column, validator)]
+        extractions = {}
+        errors = errors_by_type[entity_type] = []
+        for column in columns:
+            cr, c = concepts[column]
+            try:
+                index = add_tree(c, entity_type)
+                validator = compile_validator(c)
+            except Exception as e:
+                errors.append((column, e))
+                continue
+            extractions.setdefault(index, []).append((column, validator))
+        extractions_by_type[entity_type] = list(extractions.items())
+
+    extractors = compile_shared_rules(trees, cache=cache)
+
+    def is_applicable(cr, entity):
+        if cr in filter_errors:
+            raise filter_errors[cr]
+        for index, validator in filters_by_root[cr]:
+            data = [] if index is None else extractors[index](entity)
+            if validator is None:
+                if not len(format_data_from_nodes(list(data))):
+                    return False
+            elif not validator(data)[0]:
+                return False
+        return True
+
+    for row, (entity, entity_types) in enumerate(instances):
+        # ConceptRoot -> True, False or the exception raised
+        applicable = {}
+        for entity_type in entity_types:
+            for cr in plan.roots_by_type[entity_type]:
+                try:
+                    applicable[cr] = is_applicable(cr, entity)
+                except Exception as e:
+                    applicable[cr] = e
+
+            for column in columns_by_type[entity_type]:
+                if isinstance(applicable[concepts[column][0]], Exception):
+                    result.set_error(row, column, applicable[concepts[column][0]])
+
+            for column, e in errors_by_type[entity_type]:
+                if applicable[concepts[column][0]] is True:
+                    result.set_error(row, column, e)
+
+            for index, validators_for_rules in extractions_by_type[entity_type]:
+                # the other columns remain NOT_APPLICABLE or ERROR
+                validators_for_rules = [(column, validator) for column, validator in validators_for_rules if applicable[concepts[column][0]] is True]
+                if not validators_for_rules:
+                    continue
+
+                try:
+                    data = extractors[index](entity)
+                except Exception as e:
+                    for column, validator in validators_for_rules:
+                        result.set_error(row, column, e)
+                    continue
+
+                for column, validator in validators_for_rules:
+                    try:
+                        valid, rule_results = validator(data)
+                        result.columns[column][row] = PASS if valid else FAIL
+                    except Exception as e:
+                        result.set_error(row, column, e)
+
+    return result
 
 
 if __name__ == '__main__':
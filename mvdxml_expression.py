@@ -1,4 +1,5 @@
-import pyparsing as pp
+import re
+import functools
 
 class node(object):
     def __init__(self, args):
@@ -11,19 +12,169 @@ class node(object):
 
     def __repr__(self): return "{%s[%s]=%s}" % (self.a, self.b, self.c)
 
-word = pp.Word(pp.alphanums+"_"+" "+"/"+"#")
-quoted = pp.Combine("'" + word + "'")
-bool_value = pp.CaselessLiteral("TRUE") | pp.CaselessLiteral("FALSE")
-ref_val = word + "[" + word + "]"
-rhs = quoted | bool_value | ref_val | word
-stmt = (pp.Optional(word) + pp.Optional("[" + word + "]") + "=" + rhs).setParseAction(node)
-bool_op =  pp.CaselessLiteral("AND") | pp.CaselessLiteral("OR")
-grammar = stmt + pp.Optional(pp.OneOrMore(bool_op + stmt))
+@functools.lru_cache(maxsize=None)
+def pyparsing_grammar():
+    """
+    Builds the reference pyparsing grammar. pyparsing is only imported when an
+    expression is not handled by the fast path parser below.
+    """
+    import pyparsing as pp
 
-def parse(exprs):
+    word = pp.Word(pp.alphanums+"_"+" "+"/"+"#")
+    quoted = pp.Combine("'" + word + "'")
+    bool_value = pp.CaselessLiteral("TRUE") | pp.CaselessLiteral("FALSE")
+    ref_val = word + "[" + word + "]"
+    rhs = quoted | bool_value | ref_val | word
+    stmt = (pp.Optional(word) + pp.Optional("[" + word + "]") + "=" + rhs).setParseAction(node)
+    bool_op =  pp.CaselessLiteral("AND") | pp.CaselessLiteral("OR")
+    grammar = stmt + pp.Optional(pp.OneOrMore(bool_op + stmt))
+
+    return dict(word=word, quoted=quoted, bool_value=bool_value, ref_val=ref_val,
+                rhs=rhs, stmt=stmt, bool_op=bool_op, grammar=grammar)
+
+def __getattr__(name):
+    # the grammar elements remain available as module attributes
+    try:
+        return pyparsing_grammar()[name]
+    except KeyError:
+        raise AttributeError(name)
+
+class results(list):
+    """
+    List of parsed tokens that, like pyparsing.ParseResults, returns an empty
+    string when accessing an undefined results name
+    """
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return ""
+
+class fast_parser(object):
+    """
+    Hand-written recursive descent parser for the grammar above, returning the
+    same tokens and node objects. It follows the pyparsing semantics: whitespace
+    is skipped between tokens, words are greedy and may contain spaces, literals
+    are matched case-insensitively as prefixes and trailing input is ignored.
+    Returns None for input it does not handle, the caller then falls back on
+    pyparsing, which also reports the parse error.
+    """
+
+    whitespace = re.compile(r"[ \n\t\r]*")
+    word = re.compile(r"[A-Za-z0-9_ /#]+")
+
+    def __init__(self, s):
+        self.s = s
+
+    def skip(self, pos):
+        return self.whitespace.match(self.s, pos).end()
+
+    def match_word(self, pos, skip=True):
+        m = self.word.match(self.s, self.skip(pos) if skip else pos)
+        return (m.group(), m.end()) if m else (None, pos)
+
+    def match_literal(self, pos, *literals):
+        pos = self.skip(pos)
+        for lit in literals:
+            if self.s[pos:pos+len(lit)].upper() == lit:
+                return lit, pos + len(lit)
+        return None, pos
+
+    def rhs(self, pos):
+        # quoted
+        p = self.skip(pos)
+        if self.s[p:p+1] == "'":
+            w, p2 = self.match_word(p + 1, skip=False)
+            if w is not None and self.s[p2:p2+1] == "'":
+                return ["'" + w + "'"], p2 + 1
+        # bool_value
+        b, p = self.match_literal(pos, "TRUE", "FALSE")
+        if b:
+            return [b], p
+        # ref_val
+        w, p = self.match_word(pos)
+        if w is None:
+            return None, pos
+        o, p2 = self.match_literal(p, "[")
+        if o:
+            w2, p3 = self.match_word(p2)
+            if w2 is not None:
+                c, p4 = self.match_literal(p3, "]")
+                if c:
+                    return [w, "[", w2, "]"], p4
+        # word
+        return [w], p
+
+    def stmt(self, pos):
+        tokens = []
+        w, pos = self.match_word(pos)
+        if w is not None:
+            tokens.append(w)
+        o, p = self.match_literal(pos, "[")
+        if o:
+            w, p = self.match_word(p)
+            if w is not None:
+                c, p = self.match_literal(p, "]")
+                if c:
+                    tokens.extend(["[", w, "]"])
+                    pos = p
+        eq, pos = self.match_literal(pos, "=")
+        if not eq:
+            return None, pos
+        tokens.append(eq)
+        r, pos = self.rhs(pos)
+        if r is None:
+            return None, pos
+        tokens.extend(r)
+        if len(tokens) < 5 and not (len(tokens) == 3 and tokens[1] == '='):
+            # the node constructor would raise, leave the error to pyparsing
+            raise ValueError(tokens)
+        return node(tokens), pos
+
+    def parse(self):
+        try:
+            n, pos = self.stmt(0)
+            if n is None:
+                return None
+            result = results([n])
+            while True:
+                op, p = self.match_literal(pos, "AND", "OR")
+                if not op:
+                    break
+                n, p = self.stmt(p)
+                if n is None:
+                    break
+                result.extend([op, n])
+                pos = p
+            return result
+        except ValueError:
+            return None
+
+def parse_expression(expr):
+    result = fast_parser(expr.expandtabs()).parse()
+    if result is None:
+        result = pyparsing_grammar()["grammar"].parseString(expr)
+    return result
+
+# Maximum number of distinct expression strings kept in the parse cache
+CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def parse_cached(exprs):
+    """
+    Parses a (semicolon separated) mvdXML expression string, memoized on the raw
+    string. The parse results are shared between callers and should not be modified.
+    """
     def _():
         for expr in exprs.split(";"):
             expr = "".join(c for c in expr if c not in "\r\n")
             if not expr: continue
-            yield grammar.parseString(expr)
-    return list(_())
+            yield parse_expression(expr)
+    return tuple(_())
+
+def parse(exprs):
+    return list(parse_cached(exprs))
+
+# Hit and miss counters of the parse cache, and a function to reset it
+cache_info = parse_cached.cache_info
+cache_clear = parse_cached.cache_clear
@@ -0,0 +1,117 @@
+from xml.dom import Node
+from xml.parsers import expat
+
+class attribute(object):
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+class attributes(dict):
+    """
+    Attribute values stored as plain strings, wrapped on access to mimic
+    xml.dom.minidom.NamedNodeMap
+    """
+
+    def __getitem__(self, k):
+        return attribute(dict.__getitem__(self, k))
+
+class element(object):
+    """
+    Lightweight stand-in for the subset of xml.dom.minidom.Element used to
+    read mvdXML. Only element nodes are retained, text and comments are dropped.
+    """
+
+    __slots__ = ("localName", "attributes", "childNodes", "parentNode", "ownerDocument")
+
+    nodeType = Node.ELEMENT_NODE
+
+    def __init__(self, localName, attrs, parentNode=None, ownerDocument=None):
+        self.localName, self.attributes = localName, attributes(attrs)
+        self.parentNode, self.ownerDocument = parentNode, ownerDocument
+        self.childNodes = []
+
+    def getAttribute(self, name):
+        return self.attributes.get(name, "")
+
+    def getElementsByTagNameNS(self, ns, name):
+        # depth-first in document order, like minidom, excluding self
+        result = []
+        stack = list(reversed(self.childNodes))
+        while stack:
+            n = stack.pop()
+            if name == "*" or n.localName == name:
+                result.append(n)
+            stack.extend(reversed(n.childNodes))
+        return result
+
+    def __getstate__(self):
+        # a flat tuple pickles more compactly than the default state of slots
+        return self.localName, dict(self.attributes), self.childNodes, self.parentNode, self.ownerDocument
+
+    def __setstate__(self, state):
+        self.localName, attrs, self.childNodes, self.parentNode, self.ownerDocument = state
+        self.attributes = attributes(attrs)
+
+    def __repr__(self):
+        return "<%s>" % self.localName
+
+def local_name(name):
+    return name.rpartition(" ")[2]
+
+def iterparse(fn, tags, skip=("Definitions",), chunk_size=1 << 16):
+    """
+    Parses an mvdXML file with an expat event parser into a tree of lightweight
+    elements. Yields (event, element) tuples for start and end tags with a local
+    name in tags as soon as they are read. The document element is yielded last
+    as ("end", document). The contents of elements in skip are discarded.
+
+    :param fn: mvdXML filename
+    :param tags: set of local element names to report
+    :param skip: local element names of which only the empty element is kept
+    :param chunk_size: number of bytes fed to the parser at once
+    :return: generator of (event, element) tuples
+    """
+
+    document = element(None, {})
+    stack = [document]
+    events = []
+    # depth of the skipped subtree we are in, zero when not skipping
+    skipping = [0]
+
+    def start(name, attrs):
+        if skipping[0]:
+            skipping[0] += 1
+            return
+        parent = stack[-1]
+        e = element(local_name(name), attrs, parent, document)
+        parent.childNodes.append(e)
+        stack.append(e)
+        if e.localName in skip:
+            skipping[0] = 1
+        if e.localName in tags:
+            events.append(("start", e))
+
+    def end(name):
+        if skipping[0] > 1:
+            skipping[0] -= 1
+            return
+        skipping[0] = 0
+        e = stack.pop()
+        if e.localName in tags:
+            events.append(("end", e))
+
+    parser = expat.ParserCreate(namespace_separator=" ")
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+
+    with open(fn, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            parser.Parse(chunk, not chunk)
+            yield from events
+            del events[:]
+            if not chunk:
+                break
+
+    yield "end", document
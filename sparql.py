@@ -1,16 +1,26 @@
+import abc
 import io
 import os
+import re
+import sys
 import csv
+import time
+import socket
 import platform
 import tabulate
 import operator
 import itertools
+import functools
 import subprocess
 import ifcopenshell
+import urllib.parse
+import urllib.request
 
 from collections import defaultdict
 
-import mvdxml_expression
+from . import template
+from . import file_cache
+from . import mvdxml_expression
 
 def camel(s):
     """
@@ -33,15 +43,39 @@ STANDARD_PREFIXES = {
     'express': '<https://w3id.org/express#>',
 }
 
+# An ifcOwl namespace declared with another prefix label, or the namespace of the
+# type of an instance in N-Triples
+IFCOWL_NAMESPACE = re.compile(
+    r"@prefix\s+[\w-]*:\s*(<[^<>\s]*/IFC\w*#>)"
+    r"|<http://www\.w3\.org/1999/02/22-rdf-syntax-ns#type>\s+<([^<>\s]*/IFC\w*#)Ifc\w*>")
+
 def derive_prefix(ttlfn):
     with open(ttlfn, "r") as f:
         for ln in f:
             ln.strip()
             if ln.startswith("@prefix ifcowl"):
                 uri = ln.split(':', 1)[1].strip()[:-1].strip()
-                print("Detected ifcowl prefix", uri)
-                STANDARD_PREFIXES['ifcowl'] = uri
-                break
+            else:
+                m = IFCOWL_NAMESPACE.match(ln) if ln.startswith("@prefix") else IFCOWL_NAMESPACE.search(ln)
+                if m is None:
+                    continue
+                uri = m.group(1) or "<%s>" % m.group(2)
+            print("Detected ifcowl prefix", uri)
+            STANDARD_PREFIXES['ifcowl'] = uri
+            break
+
+@functools.lru_cache(maxsize=None)
+def schema_by_prefix(prefix):
+    """
+    Returns the IFC latebound schema definition for an ifcOwl prefix URI
+
+    :param prefix: ifcOwl prefix, e.g. <https://w3id.org/ifc/IFC4_ADD2#>
+    :return: schema definition
+    """
+    schema_name = prefix.split('/')[-1][:-2]
+    if "_" in schema_name:
+        schema_name = schema_name.split('_')[0]
+    return ifcopenshell.ifcopenshell_wrapper.schema_by_name(schema_name)
 
 def withschema(fn):
     """
@@ -54,13 +88,36 @@ def withschema(fn):
     """
 
     def _(*args, **kwargs):
-        schema_name = STANDARD_PREFIXES['ifcowl'].split('/')[-1][:-2]
-        if "_" in schema_name:
-            schema_name = schema_name.split('_')[0]
-        S = ifcopenshell.ifcopenshell_wrapper.schema_by_name(schema_name)
+        S = schema_by_prefix(STANDARD_PREFIXES['ifcowl'])
         return fn(S, *args, **kwargs)
     return _
 
+# (schema name, function name) -> {arguments: result}
+lookup_tables = defaultdict(dict)
+
+def memoized(fn):
+    """
+    Decorator for the ifcOwl lookups that take a schema definition as the first
+    parameter. Results are stored per schema in lookup_tables, so that the
+    schema is only inspected once for every entity and attribute, and reused
+    for every rule of every template. Lookups that raise are not stored.
+
+    :param fn: input function
+    :return: decorated function
+    """
+
+    def _(S, *args):
+        table = lookup_tables[S.name(), fn.__name__]
+        try:
+            return table[args]
+        except KeyError:
+            result = table[args] = fn(S, *args)
+            return result
+        except TypeError:
+            # unhashable arguments, such as parsed constraints
+            return fn(S, *args)
+    return _
+
 noop = lambda *args: None
 
 class rule_binding(object):
@@ -117,23 +174,26 @@ class ifcOwl(object):
 
     @staticmethod
     @withschema
+    @memoized
     def supertypes(S, entity):
         """
-        Yields ifcOwl subtypes for the supplied entity name
+        Returns the ifcOwl supertypes for the supplied entity name
 
         :param S: schema definition (from decorator)
         :param entity: entity name string
-        :return:
+        :return: tuple of entity name strings
         """
 
         a, b = entity.split('#')
+        supertypes = []
         try:
             en = S.declaration_by_name(b)
             if en.__class__.__name__ == "entity":
                 while en.supertype():
-                    yield "%s#%s" % (a, en.supertype().name())
+                    supertypes.append("%s#%s" % (a, en.supertype().name()))
                     en = en.supertype()
         except: pass
+        return tuple(supertypes)
 
     @staticmethod
     def get_names(e, c):
@@ -148,8 +208,7 @@ class ifcOwl(object):
         return set(map(lambda a: a.name(), getattr(e, c)()))
 
     @staticmethod
-    @withschema
-    def is_boxed(S, entity, attribute, predCount=0):
+    def is_boxed(entity, attribute, predCount=0):
         """
         Returns whether the entity attribute should be boxed in ifcOwl. Which means
         that there is an additional indirection.
@@ -161,13 +220,31 @@ class ifcOwl(object):
             rdf:type           ifcowl:IfcGloballyUniqueId ;
             express:hasString  "2P9FPkykn0r8rCpmBxZH0w" .
 
-        :param S: schema definition (from decorator)
         :param entity: entity name string
         :param attribute: attribute name string
         :param predCount: numeric identifier to postfix predicate identifier in case of SELECT types
         :return: either a predicate from the express namespace or a variable postfixed with predCount
         """
 
+        boxing = ifcOwl.boxing(entity, attribute)
+        if boxing is None:
+            return "?pred%d" % predCount
+        return boxing
+
+    @staticmethod
+    @withschema
+    @memoized
+    def boxing(S, entity, attribute):
+        """
+        Returns the boxing predicate of the entity attribute, see is_boxed(), or
+        None for SELECT types, for which the predicate is a variable
+
+        :param S: schema definition (from decorator)
+        :param entity: entity name string
+        :param attribute: attribute name string
+        :return: a predicate from the express namespace, False or None
+        """
+
         en = S.declaration_by_name(entity)
         attr = [a for a in en.all_attributes() if a.name() == attribute][0]
         ty = attr.type_of_attribute()
@@ -181,7 +258,7 @@ class ifcOwl(object):
             # It could be all instance references, but fact is we don't know at this moment.
             # It's likely that mvdXML will only bind to literals?
 
-            return "?pred%d" % predCount
+            return None
 
         else:
 
@@ -196,6 +273,7 @@ class ifcOwl(object):
 
     @staticmethod
     @withschema
+    @memoized
     def name(S, entity, attribute):
         """
         Names the entity attribute according to ifcOwl
@@ -227,6 +305,7 @@ class ifcOwl(object):
 
     @staticmethod
     @withschema
+    @memoized
     def is_select(S, decl_name):
         """
         Returns True when the declaration is a select type
@@ -240,6 +319,7 @@ class ifcOwl(object):
 
     @staticmethod
     @withschema
+    @memoized
     def is_inverse(S, entity, attribute):
         """
         When entity attribute is an INVERSE attribute, returns the opposite
@@ -318,11 +398,23 @@ class convertor(object):
 
         bld.append("SELECT " + " ".join("?" + a for a in args) + " WHERE {")
 
-        args = set(args)
-
         bld.append("?URI", "rdf:type", "ifcowl:%s" % rootEntity)
         bld.append("?URI", "ifcowl:globalId_IfcRoot/express:hasString", "?GlobalId")
 
+        convertor.pattern(template, bld, rootEntity)
+
+        bld.append("}")
+
+        return bld
+
+    @staticmethod
+    def pattern(template, bld, rootEntity, indent=""):
+        """
+        Appends the graph pattern and FILTER of the template rules, starting from ?URI
+
+        :param indent: Prefix for the appended statements
+        """
+
         nm = "?URI"
         ROOT = type('_', (), {'attribute': rootEntity})()
         # rule_stack = [ROOT]
@@ -337,7 +429,7 @@ class convertor(object):
             # print "AAA", rule.tag, parent.tag if parent else parent
             # print map(id, rule_stack)
             # print name_stack
-            INDENT = " " * (len(parents) * 2)
+            INDENT = indent + " " * (len(parents) * 2)
             return_value = None
 
             if rule.optional:
@@ -422,22 +514,76 @@ class convertor(object):
         # while callback_stack:
         #     callback_stack.pop()()
 
-        if template.params:
-            bld.append(convertor.build_filter(template))
+        if template.constraints:
+            bld.append(indent + convertor.build_filter(template))
+
+    @staticmethod
+    def concept_root(CR):
+        """
+        Convert all concepts of a ConceptRoot into a single query. The root entities are
+        matched once and every concept is evaluated in an OPTIONAL subquery over ?URI,
+        bound to a boolean column ?c<i>, ?c0 being the applicability. The result set
+        is the pass/fail matrix of the root entities.
+
+        :param CR: A parsed concept root
+        :return: builder with the query and its result columns in args
+        """
+
+        try:
+            applicability = CR.applicability()
+        except IndexError:
+            # without Applicability all root entities are applicable
+            applicability = None
+
+        concepts = list(itertools.chain([applicability], CR.concepts()))
+        columns = ["c%d" % ci for ci in range(len(concepts))]
+
+        bld = builder()
+        bld.args = ["URI", "GlobalId"] + columns
+        bld.append("# %s" % camel(CR.name))
+        bld.append("SELECT " + " ".join("?" + a for a in bld.args) + " WHERE {")
+        bld.append("?URI", "rdf:type", "ifcowl:%s" % CR.entity)
+        bld.append("?URI", "ifcowl:globalId_IfcRoot/express:hasString", "?GlobalId")
+
+        for C, column in zip(concepts, columns):
+            if C is None:
+                bld.append("BIND(true AS ?%s)" % column)
+                continue
+
+            # the subquery only projects ?URI, so variables of different concepts do not clash
+            bld.append("# %s" % C.name)
+            bld.append("OPTIONAL {")
+            bld.append("  SELECT DISTINCT ?URI (true AS ?%s_) WHERE {" % column)
+            bld.append("    ?URI", "rdf:type", "ifcowl:%s" % CR.entity)
+            convertor.pattern(C.template(), bld, CR.entity, indent="    ")
+            bld.append("  }")
+            bld.append("}")
+            bld.append("BIND(BOUND(?%s_) AS ?%s)" % (column, column))
 
         bld.append("}")
+        bld.bind(STANDARD_PREFIXES)
 
         return bld
 
     @staticmethod
     def build_filter(self):
+        def literal(c):
+            # quoted strings and numbers are kept, bare words compared as strings
+            if c.startswith("'"):
+                return c
+            try:
+                float(c)
+                return c
+            except ValueError:
+                return "'%s'" % c
+
         def v(p):
             if isinstance(p, mvdxml_expression.node):
-                if p.b == "Value":
+                if p.b == "Value" or p.b is None:
                     if p.c.lower() in {'true', 'false'}:
                         yield "(%s?%s)" % ("!" if p.c.lower() == "false" else "", p.a)
                     else:
-                        yield "(?%s = %s)" % (p.a, p.c)
+                        yield "(?%s = %s)" % (p.a, literal(p.c))
                 elif p.b == "Exists":
                     yield "(!isBLANK(?%s))" % p.a
                 else:
@@ -454,146 +600,601 @@ class convertor(object):
                     yield from v(q)
                 yield ")"
 
-        return "FILTER(%s)" % " ".join(v(self.params))
+        return "FILTER(%s)" % " ".join(v(self.constraints))
 
-def infer_subtypes(ttlfn):
-    # Disabled currently
-    return ttlfn
+RDF_TYPE = "<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>"
 
-    if not os.path.exists(ttlfn + ".subclass.nt"):
+TURTLE_LONG_STRING = re.compile(r'"{3}(?:[^"\\]|\\.|"(?!""))*"{3}' "|" r"'{3}(?:[^'\\]|\\.|'(?!''))*'{3}")
 
-        print("Inferring supertype relationships")
+TURTLE_TOKEN = re.compile(r"""
+    (?P<ws>\s+|\#[^\r\n]*)
+  | (?P<iri><[^<>"{}|^`\\\s]*>)
+  | (?P<long>%s)
+  | (?P<string>"(?:[^"\\\r\n]|\\.)*"|'(?:[^'\\\r\n]|\\.)*')
+  | (?P<at>@[A-Za-z]+(?:-[A-Za-z0-9]+)*)
+  | (?P<caret>\^\^)
+  | (?P<number>[+-]?(?:\d*\.\d+|\d+)(?:[eE][+-]?\d+)?)
+  | (?P<punct>[;,.\[\]()])
+  | (?P<name>(?:[^\s;,.()\[\]<>"'\\\#^@]|\\.|\.(?=[^\s;,.()\[\]<>"'\#]))+)
+""" % TURTLE_LONG_STRING.pattern, re.X)
 
-        import hashlib
-        import rdflib
-
-        a = rdflib.namespace.RDF.type
+TURTLE_ESCAPES = {"t": "\t", "b": "\b", "n": "\n", "r": "\r", "f": "\f"}
 
-        # Hardly possible on Windows
-        # graph = rdflib.Graph("Sleepycat")
-        # graph.open("store", create=True)
-        # graph.parse(ttlfn)
+def iter_triples(fn):
+    """
+    Streaming reader for Turtle and N-Triples. The file is read line by line and
+    the triples are yielded per statement as tuples of terms in N-Triples syntax,
+    so that only the prefixes and the statement being read are kept in memory.
 
-        from sqlalchemy import create_engine
-        from rdflib_sqlalchemy.store import SQLAlchemy
+    :param fn: A filename of a Turtle or N-Triples file
+    :return: generator of (subject, predicate, object) tuples
+    """
 
-        if os.path.exists("db.sqlite"):
-            os.unlink("db.sqlite")
+    def tokens(f):
+        buf, pos = "", 0
+        for line in f:
+            buf, pos = buf[pos:] + line, 0
+            while pos < len(buf):
+                if buf.startswith(('"""', "'''"), pos) and not TURTLE_LONG_STRING.match(buf, pos):
+                    # a long string continues on the next line
+                    break
+                m = TURTLE_TOKEN.match(buf, pos)
+                if m is None:
+                    raise ValueError("Invalid Turtle near %r" % buf[pos:pos+40])
+                pos = m.end()
+                if m.lastgroup != "ws":
+                    yield m.lastgroup, m.group()
+        if buf[pos:].strip():
+            raise ValueError("Unterminated string %r" % buf[pos:pos+40])
+
+    def unescape(s):
+        return re.sub(
+            r"\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))",
+            lambda m: TURTLE_ESCAPES.get(m.group(3), m.group(3)) if m.group(3) else chr(int(m.group(1) or m.group(2), 16)),
+            s)
+
+    def escape(s):
+        return s.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r")
+
+    prefixes = {}
+    base = ""
+    # the triples of the statement being read
+    triples = []
+    bnodes = itertools.count()
+
+    with open(fn, encoding="utf-8") as f:
+        stream = tokens(f)
+        lookahead = [next(stream, (None, None))]
+
+        def peek():
+            return lookahead[0][1]
+
+        def take():
+            t = lookahead[0]
+            lookahead[0] = next(stream, (None, None))
+            return t
+
+        def expect(text):
+            kind, t = take()
+            if t != text:
+                raise ValueError("Expected %r, found %r" % (text, t))
+
+        def iri(kind, t):
+            if kind == "iri":
+                if re.match(r"<[A-Za-z][A-Za-z0-9+.-]*:", t):
+                    return t
+                # relative to the base, urljoin() would drop an empty fragment of absolute IRIs
+                return "<%s>" % urllib.parse.urljoin(base, t[1:-1])
+            if kind == "name" and ":" in t and not t.startswith("_:"):
+                prefix, local = t.split(":", 1)
+                if prefix not in prefixes:
+                    raise ValueError("Undefined prefix %r" % prefix)
+                return "<%s%s>" % (prefixes[prefix], re.sub(r"\\(.)", r"\1", local))
+            raise ValueError("Expected an IRI, found %r" % t)
+
+        def literal(kind, t):
+            if kind == "string" and t[0] == '"':
+                # Turtle and N-Triples have the same escapes
+                value = t
+            else:
+                value = '"%s"' % escape(unescape(t[3:-3] if kind == "long" else t[1:-1]))
+            if lookahead[0][0] == "at":
+                return value + take()[1]
+            if lookahead[0][0] == "caret":
+                take()
+                return "%s^^%s" % (value, iri(*take()))
+            return value
+
+        def node(kind, t):
+            # a subject or an object
+            if kind == "name" and t.startswith("_:"):
+                return t
+            if kind == "iri" or (kind == "name" and t not in ("true", "false")):
+                return iri(kind, t)
+            if kind in ("string", "long"):
+                return literal(kind, t)
+            if kind == "number":
+                datatype = "double" if "e" in t.lower() else "decimal" if "." in t else "integer"
+                return '"%s"^^<http://www.w3.org/2001/XMLSchema#%s>' % (t, datatype)
+            if t in ("true", "false"):
+                return '"%s"^^<http://www.w3.org/2001/XMLSchema#boolean>' % t
+            if t == "[":
+                n = "_:mvdb%d" % next(bnodes)
+                if peek() != "]":
+                    predicate_object_list(n)
+                expect("]")
+                return n
+            if t == "(":
+                items = []
+                while peek() != ")":
+                    items.append(node(*take()))
+                take()
+                head = "<http://www.w3.org/1999/02/22-rdf-syntax-ns#nil>"
+                for item in reversed(items):
+                    n = "_:mvdb%d" % next(bnodes)
+                    triples.append((n, "<http://www.w3.org/1999/02/22-rdf-syntax-ns#first>", item))
+                    triples.append((n, "<http://www.w3.org/1999/02/22-rdf-syntax-ns#rest>", head))
+                    head = n
+                return head
+            raise ValueError("Unexpected %r" % t)
+
+        def predicate_object_list(s):
+            while True:
+                kind, t = take()
+                p = RDF_TYPE if t == "a" else iri(kind, t)
+                triples.append((s, p, node(*take())))
+                while peek() == ",":
+                    take()
+                    triples.append((s, p, node(*take())))
+                if peek() != ";":
+                    return
+                while peek() == ";":
+                    take()
+                if peek() in (".", "]", None):
+                    return
+
+        while lookahead[0][0] is not None:
+            kind, t = take()
+            if t in ("@prefix", "@base") or (kind == "name" and t.upper() in ("PREFIX", "BASE")):
+                if t.lower().endswith("prefix"):
+                    name = take()[1]
+                    prefixes[name[:-1]] = iri(*take())[1:-1]
+                else:
+                    base = iri(*take())[1:-1]
+                if t.startswith("@"):
+                    expect(".")
+                continue
 
-        uri = rdflib.Literal("sqlite:///%(here)s/db.sqlite" % {"here": os.getcwd()})
-        ident = rdflib.URIRef(hashlib.sha1(ttlfn.encode()).hexdigest())
-        engine = create_engine(uri)
-        store = SQLAlchemy(
-            identifier=ident,
-            engine=engine,
-        )
-        graph = rdflib.Graph(
-            store,
-            identifier=ident,
-        )
-        graph.open(uri, create=True)
-        graph.parse(ttlfn, format="ttl")
+            s = node(kind, t)
+            if not (t == "[" and peek() == "."):
+                predicate_object_list(s)
+            expect(".")
 
-        # print out all the triples in the graph
-        def _():
-            for subject, predicate, object in graph:
-                if predicate == a:
-                    for sup in ifcOwl.supertypes(object):
-                        yield subject, a, rdflib.URIRef(sup)
+            yield from triples
+            del triples[:]
 
-        for stmt in list(_()):
-            graph.add(stmt)
+def infer_subtypes(ttlfn, cache_dir=None):
+    """
+    Adds the rdf:type statements for the supertypes of every typed ifcOwl entity
+    instance, so that queries for e.g. IfcWall also match IfcWallStandardCase.
+    The model is streamed once and written, with the inferred statements, as
+    N-Triples. The supertype closure is computed up front with ifcOwl.supertypes()
+    for all entities of the schema. Duplicate statements are not removed. The
+    result is stored in cache_dir, keyed by the hash of the file contents and
+    the ifcOwl prefix, and reused for the same model.
+
+    :param ttlfn: A filename for the LD representation of an IFC model, Turtle
+                  or N-Triples (.nt), with the ifcOwl prefix set by derive_prefix().
+                  Without a prefix the file is returned unchanged.
+    :param cache_dir: directory of the inferred files, by default
+        $XDG_CACHE_HOME/ifcopenshell/mvd or ~/.cache/ifcopenshell/mvd
+    :return: filename of the N-Triples file with the inferred statements
+    """
 
-        graph.serialize(destination=ttlfn + ".subclass.nt", format="nt")
+    prefix = STANDARD_PREFIXES['ifcowl']
+    if not prefix:
+        print("No ifcowl prefix detected, supertype relationships are not inferred")
+        return ttlfn
+
+    if cache_dir is None:
+        cache_dir = file_cache.default_cache_dir()
+
+    ntfn = os.path.join(cache_dir, file_cache.file_digest(ttlfn, prefix) + ".subclass.nt")
+
+    if os.path.exists(ntfn):
+        return ntfn
+
+    print("Inferring supertype relationships")
+
+    # rdf:type object -> objects of the inferred rdf:type statements
+    ns = prefix[1:-1]
+    closure = {}
+    for en in schema_by_prefix(prefix).entities():
+        supertypes = ifcOwl.supertypes(ns + en.name())
+        if supertypes:
+            closure["<%s%s>" % (ns, en.name())] = ["<%s>" % st for st in supertypes]
+
+    with file_cache.atomic_write(ntfn, "w", encoding="utf-8") as out:
+        if ttlfn.endswith(".nt"):
+            # N-Triples are copied line by line
+            with open(ttlfn, encoding="utf-8") as f:
+                for ln in f:
+                    out.write(ln)
+                    s, p, o = (ln.split(None, 2) + ["", ""])[:3]
+                    if p == RDF_TYPE:
+                        for st in closure.get(o.rstrip()[:-1].rstrip(), ()):
+                            out.write("%s %s %s .\n" % (s, RDF_TYPE, st))
+        else:
+            for s, p, o in iter_triples(ttlfn):
+                out.write("%s %s %s .\n" % (s, p, o))
+                if p == RDF_TYPE:
+                    for st in closure.get(o, ()):
+                        out.write("%s %s %s .\n" % (s, RDF_TYPE, st))
 
-    ttlfn += ".subclass.nt"
+    return ntfn
 
 if platform.system() == "Windows":
     JENA_SPARQL = os.path.join(os.environ.get("JENA_HOME"), "bat", "sparql.bat")
 else:
     JENA_SPARQL = "sparql"
 
+def read_csv(s):
+    """
+    Returns the rows of a SPARQL CSV result as tuples, without the header
+    """
+    rows = csv.reader(io.StringIO(s))
+    next(rows, None)
+    return list(map(tuple, rows))
+
+class engine(abc.ABC):
+    """
+    Base class of the SPARQL engines used by the executor. An engine holds the
+    building model and returns the result rows of a query as tuples, in the
+    order of the projected variables. Unbound values are empty or None.
+    """
+
+    # seconds spent loading the model up front, if any
+    load_time = None
+
+    def __init__(self, ttlfn):
+        self.ttlfn = ttlfn
+
+    @abc.abstractmethod
+    def query(self, query, sparqlfn):
+        """
+        :param query: SPARQL query, as a string or builder
+        :param sparqlfn: Filename the query is stored in
+        :return: list of tuples
+        """
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class jena(engine):
+    """
+    Runs every query in a fresh Jena ARQ process, which parses the model again each time
+    """
+
+    def query(self, query, sparqlfn):
+        proc = subprocess.Popen(
+            [JENA_SPARQL, "--data=" + self.ttlfn, "--query=" + sparqlfn, "--results=CSV"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+
+        return read_csv(stdout.decode('utf-8'))
+
+class fuseki(engine):
+    """
+    Loads the model once into a local, in-memory Fuseki server and submits all
+    queries to its SPARQL endpoint over HTTP
+
+    :param ttlfn: A filename for the LD representation of an IFC model
+    :param port: Port to listen on, by default a free port is picked
+    :param timeout: Seconds to wait for the server to load the model
+    """
+
+    def __init__(self, ttlfn, port=None, timeout=600.):
+        super(fuseki, self).__init__(ttlfn)
+
+        if port is None:
+            with socket.socket() as s:
+                s.bind(("localhost", 0))
+                port = s.getsockname()[1]
+
+        url = "http://localhost:%d" % port
+        self.endpoint = url + "/mvd/query"
+
+        if platform.system() == "Windows":
+            # resolved here, so that the other engines do not require FUSEKI_HOME
+            server = os.path.join(os.environ["FUSEKI_HOME"], "fuseki-server.bat")
+        else:
+            server = "fuseki-server"
+
+        t0 = time.perf_counter()
+        self.proc = subprocess.Popen(
+            [server, "--file=" + ttlfn, "--port=%d" % port, "/mvd"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+
+        # the server only starts listening once the model is loaded
+        while True:
+            try:
+                urllib.request.urlopen(url + "/$/ping").close()
+                break
+            except OSError:
+                if self.proc.poll() is not None:
+                    raise RuntimeError("Fuseki server exited with code %d" % self.proc.returncode)
+                if time.perf_counter() - t0 > timeout:
+                    self.close()
+                    raise RuntimeError("Fuseki server did not start within %d seconds" % timeout)
+                time.sleep(0.1)
+
+        self.load_time = time.perf_counter() - t0
+
+    def query(self, query, sparqlfn):
+        request = urllib.request.Request(
+            self.endpoint,
+            data=urllib.parse.urlencode({"query": str(query)}).encode("utf-8"),
+            headers={"Accept": "text/csv"})
+
+        with urllib.request.urlopen(request) as response:
+            return read_csv(response.read().decode('utf-8'))
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+
+class rdflib_graph(engine):
+    """
+    Parses the model once into an in-process rdflib graph and evaluates the queries
+    with rdflib. No Java runtime is needed. Optionally the parsed graph is stored in
+    cache_dir, keyed by the hash of the file contents and the rdflib and Python
+    versions, so that subsequent runs on the same model skip parsing.
+
+    :param ttlfn: A filename for the LD representation of an IFC model
+    :param cache_dir: Directory of the cached graphs, by default nothing is stored
+    """
+
+    def __init__(self, ttlfn, cache_dir=None):
+        super(rdflib_graph, self).__init__(ttlfn)
+
+        import rdflib
+
+        t0 = time.perf_counter()
+
+        cache_fn = None
+        if cache_dir is not None:
+            cache_fn = os.path.join(cache_dir, file_cache.file_digest(
+                ttlfn, rdflib.__version__, "%d.%d" % sys.version_info[:2]) + ".graph.pickle")
+            self.graph = file_cache.load_pickle(cache_fn)
+        else:
+            self.graph = None
+
+        if self.graph is None:
+            self.graph = rdflib.Graph()
+            self.graph.parse(ttlfn, format="nt" if ttlfn.endswith(".nt") else "turtle")
+
+            if cache_fn is not None:
+                file_cache.store_pickle(self.graph, cache_fn)
+
+        self.load_time = time.perf_counter() - t0
+
+    @staticmethod
+    def plan(node, known=frozenset()):
+        """
+        Reorders the triple patterns of the basic graph patterns in a translated
+        query. rdflib evaluates a BGP with the patterns with most bound terms first,
+        which for patterns like `?a rdf:type X . ?b rdf:type Y . ?a p ?b` results in
+        a cross product. Here patterns connected to already bound variables go
+        first, including the variables bound by the left hand side of lazy joins
+        and OPTIONALs, which rdflib evaluates per solution of the left hand side.
+
+        :param node: rdflib algebra node, its BGPs are replaced
+        :param known: variables bound when evaluating node
+        :return: variables bound after evaluating node
+        """
+        from rdflib.plugins.sparql.parserutils import CompValue
+
+        if not isinstance(node, CompValue):
+            return known
+
+        def child(key, known):
+            c = node.get(key)
+            if isinstance(c, CompValue) and c.name == "BGP":
+                node[key], known = rdflib_graph.plan_bgp(c.triples, known)
+                return known
+            return rdflib_graph.plan(c, known)
+
+        if node.name == "LeftJoin" or (node.name == "Join" and node.lazy):
+            left = child("p1", known)
+            right = child("p2", left)
+            # the variables of an OPTIONAL are not necessarily bound
+            return left if node.name == "LeftJoin" else right
+
+        result = known
+        for key in ("p", "p1", "p2"):
+            result = result | child(key, known)
+        return result
+
+    @staticmethod
+    def plan_bgp(triples, known):
+        """
+        Orders triple patterns greedily, connected and most bound first. As rdflib
+        sorts the patterns of a BGP again on the number of terms unbound when it
+        starts evaluating it, the ordered patterns are split into BGPs in which that
+        order is preserved, evaluated one after the other as lazy joins.
+
+        :return: (algebra node, variables bound after evaluating it)
+        """
+        from rdflib.term import Variable, BNode
+        from rdflib.plugins.sparql.parserutils import CompValue
+
+        is_var = lambda x: isinstance(x, (Variable, BNode))
+
+        def score(t):
+            vs = [x for x in t if is_var(x)]
+            return any(v in bound for v in vs), len(t) - len(vs) + sum(v in bound for v in vs)
+
+        bound, remaining, segments = set(known), list(triples), []
+        # the variables bound before the current segment, and the sort key of its last pattern
+        segment_known, last = set(known), None
+
+        while remaining:
+            t = remaining.pop(max(range(len(remaining)), key=lambda i: score(remaining[i])))
+            unbound = sum(is_var(x) and x not in segment_known for x in t)
+            if last is None or unbound < last:
+                segment_known = set(bound)
+                unbound = sum(is_var(x) and x not in segment_known for x in t)
+                segments.append([])
+            segments[-1].append(t)
+            last = unbound
+            bound.update(x for x in t if is_var(x))
+
+        def bgp(ts):
+            return CompValue("BGP", triples=ts, _vars=set(x for t in ts for x in t if is_var(x)))
+
+        def join(a, b):
+            return CompValue("Join", p1=a, p2=b, lazy=True, _vars=a._vars | b._vars)
+
+        node = functools.reduce(join, map(bgp, segments)) if segments else bgp([])
+        return node, frozenset(bound)
+
+    def query(self, query, sparqlfn):
+        from rdflib.plugins.sparql import prepareQuery
+
+        q = prepareQuery(str(query))
+        rdflib_graph.plan(q.algebra)
+
+        return [
+            tuple(None if v is None else str(v) for v in row)
+            for row in self.graph.query(q)
+        ]
+
+# SPARQL engines by name, as accepted by executor.run
+engines = {
+    "jena": jena,
+    "fuseki": fuseki,
+    "rdflib": rdflib_graph,
+}
+
 class executor(object):
     @staticmethod
-    def run(CR, fn, ttlfn):
+    def run(CR, fn, ttlfn, engine=None, combined=False):
         """
         Generates SPARQL queries for the parsed MVD and executes on the building model
 
         :param CR: A parsed concept root
         :param fn: A filename used as the prefix to store generate SPARQL queries to disk
         :param ttlfn: A filename for the LD representation of an IFC model
+        :param engine: A SPARQL engine holding the model of ttlfn, to share it between
+                       concept roots, or the name of one in engines to start for this
+                       run. By default a jena engine is used.
+        :param combined: Evaluate all concepts of the ConceptRoot in a single query
         :return:
         """
 
-        def dict_to_list(headers):
-            return lambda di: [di[h] for h in headers]
+        if engine is None or isinstance(engine, str):
+            with engines[engine or "jena"](ttlfn) as engine:
+                return executor.run(CR, fn, ttlfn, engine, combined)
+
+        # (query name, number of rows, seconds) for the summary below
+        costs = []
 
-        def execute(query, *args):
+        def execute(query, name, *args):
             sparqlfn = ".".join(itertools.chain([fn], map(str, args))) + ".sparql"
             with open(sparqlfn, "w") as f:
                 print(query, file=f)
 
-            proc = subprocess.Popen(
-                [JENA_SPARQL, "--data=" + ttlfn, "--query=" + sparqlfn, "--results=CSV"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-            stdout, stderr = proc.communicate()
-
-            csvf = io.StringIO(stdout.decode('utf-8'))
+            t0 = time.perf_counter()
+            rows = engine.query(query, sparqlfn)
+            costs.append((name, len(rows), time.perf_counter() - t0))
 
-            return list(csv.DictReader(csvf))
+            return rows
 
-        root_query = convertor.root(CR.entity)
-        roots = execute(root_query, 0)
-
-        print("\nFile contains %d elements of type %s" % (len(roots), CR.entity))
+        is_template = isinstance(CR, template)
+        if is_template:
+            concept_enumerator = [CR]
+        else:
+            # Full MVD with multiple concepts
+            try:
+                applicability = CR.applicability()
+            except IndexError:
+                # without Applicability all root entities are applicable
+                applicability = None
+            concept_enumerator = list(itertools.chain([applicability], CR.concepts()))
 
         passing_all = {}
 
         # for summary below
-        num_columns = 0
+        num_columns = len(concept_enumerator)
 
-        try:
-            # Full MVD with multiple concepts
-            is_template = False
-            concept_enumerator = list(itertools.chain([CR.applicability()], CR.concepts()))
-        except:
-            is_template = True
-            concept_enumerator = [CR]
+        if combined and not is_template:
+            query = convertor.convert(CR)
 
-        for ci, C in enumerate(concept_enumerator):
+            print("\nSPARQL query")
+            print("============")
+            print(query)
 
-            num_columns += 1
+            roots = execute(query, CR.name, 0)
 
-            if is_template or ci > 1:
-                print("\n%s" % C.name)
-            else:
-                print("\nApplicability")
+            print("\nFile contains %d elements of type %s" % (len(roots), CR.entity))
 
-            query = convertor.convert(C)
+            for ci in range(num_columns):
+                i = query.args.index("c%d" % ci)
+                passing_all[ci] = set(r[1] for r in roots if r[i] == "true")
 
-            print("\nSPARQL query")
-            print("============")
-            print(query)
+        else:
+            root_query = convertor.root(CR.entity)
+            roots = execute(root_query, CR.entity, 0)
+
+            print("\nFile contains %d elements of type %s" % (len(roots), CR.entity))
+
+            for ci, C in enumerate(concept_enumerator):
 
-            passing = execute(query, ci, 1)
-            passing_guids = set(r['GlobalId'] for r in passing)
+                if C is None:
+                    print("\nApplicability")
+                    print("\nAll elements are applicable")
+                    passing_all[ci] = set(r[1] for r in roots)
+                    continue
+
+                if is_template or ci > 1:
+                    print("\n%s" % C.name)
+                else:
+                    print("\nApplicability")
 
-            print("\nElements passing")
-            print(tabulate.tabulate(list(map(dict_to_list(query.args), passing)), query.args, tablefmt="grid"))
+                query = convertor.convert(C)
 
-            print("\nElements failing concept")
-            hd = ["URI", "GlobalId"]
-            print(tabulate.tabulate(
-                list(map(dict_to_list(hd), [r for r in roots if r["GlobalId"] not in passing_guids])), hd,
-                tablefmt="grid"))
+                print("\nSPARQL query")
+                print("============")
+                print(query)
 
-            passing_all[ci] = passing_guids
+                passing = execute(query, C.name, ci, 1)
+                # the first two columns are always ?URI ?GlobalId
+                passing_guids = set(r[1] for r in passing)
+
+                print("\nElements passing")
+                print(tabulate.tabulate(passing, query.args, tablefmt="grid"))
+
+                print("\nElements failing concept")
+                hd = ["URI", "GlobalId"]
+                print(tabulate.tabulate(
+                    [r for r in roots if r[1] not in passing_guids], hd,
+                    tablefmt="grid"))
+
+                passing_all[ci] = passing_guids
 
         print("\nSummary")
 
         for ci, C in enumerate(concept_enumerator):
-            print("(%d) %s" % (ci+(0 if is_template else 0), C.name))
+            print("(%d) %s" % (ci+(0 if is_template else 0), "Applicability" if C is None else C.name))
 
         def get_stats(guid):
             v = lambda i: guid in passing_all[i]
@@ -606,4 +1207,10 @@ class executor(object):
         if not is_template:
             hd += ["Valid"]
 
-        print(tabulate.tabulate(list(map(get_stats, map(operator.itemgetter("GlobalId"), roots))), hd, tablefmt="grid"))
\ No newline at end of file
+        print(tabulate.tabulate(list(map(get_stats, map(operator.itemgetter(1), roots))), hd, tablefmt="grid"))
+
+        print("\nQuery cost")
+        if engine.load_time is not None:
+            print("Model loaded in %.3fs" % engine.load_time)
+        hd = ["Query", "Rows", "Seconds"]
+        print(tabulate.tabulate(costs + [("Total", sum(c[1] for c in costs), sum(c[2] for c in costs))], hd, tablefmt="grid", floatfmt=".3f"))
@@ -0,0 +1,8 @@
+import sys
+import importlib
+
+import ifcopenshell
+
+# mvd.py refers to this package as ifcopenshell.mvd, the name it is installed under
+package = importlib.import_module(__package__.rpartition(".")[0])
+sys.modules["ifcopenshell.mvd"] = ifcopenshell.mvd = package
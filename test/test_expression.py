@@ -0,0 +1,55 @@
+import glob
+import html
+import os
+import re
+
+import pytest
+
+from .. import mvdxml_expression
+
+EXAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "mvd_examples", "**", "*.mvdxml"), recursive=True))
+
+def example_expressions():
+    # Read from the text rather than the DOM, so that the sample rules in
+    # comments and CDATA sections are included as well
+    exprs = set()
+    for fn in EXAMPLES:
+        with open(fn, encoding="utf-8") as f:
+            for v in re.findall(r'(?:Parameters|Expression)="([^"]*)"', f.read()):
+                for expr in html.unescape(v).split(";"):
+                    expr = "".join(c for c in expr if c not in "\r\n")
+                    if expr:
+                        exprs.add(expr)
+    return sorted(exprs)
+
+EXPRESSIONS = example_expressions()
+ACCEPTED = [e for e in EXPRESSIONS if mvdxml_expression.fast_parser(e.expandtabs()).parse() is not None]
+REJECTED = [e for e in EXPRESSIONS if e not in ACCEPTED]
+
+def tokens(result):
+    return [(x.a, x.b, x.c) if isinstance(x, mvdxml_expression.node) else x for x in result]
+
+@pytest.mark.parametrize("expr", ACCEPTED)
+def test_fast_parser_matches_pyparsing(expr):
+    fast = mvdxml_expression.fast_parser(expr.expandtabs()).parse()
+    reference = mvdxml_expression.pyparsing_grammar()["grammar"].parseString(expr)
+    assert tokens(fast) == tokens(reference)
+
+@pytest.mark.parametrize("expr", REJECTED)
+def test_fallback_to_pyparsing(expr, monkeypatch):
+    import pyparsing as pp
+
+    calls = []
+    grammar = mvdxml_expression.pyparsing_grammar
+
+    def counted():
+        calls.append(None)
+        return grammar()
+
+    monkeypatch.setattr(mvdxml_expression, "pyparsing_grammar", counted)
+    with pytest.raises(pp.ParseException) as reference:
+        grammar()["grammar"].parseString(expr)
+    with pytest.raises(pp.ParseException) as fallback:
+        mvdxml_expression.parse_expression(expr)
+    assert calls
+    assert str(fallback.value) == str(reference.value)
@@ -0,0 +1,44 @@
+import glob
+import os
+
+import pytest
+
+from xml.dom.minidom import Node
+
+from .. import concept_root, template
+
+EXAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "mvd_examples", "**", "*.mvdxml"), recursive=True))
+
+def child_has_ruleid_or_prefix(node):
+    # the recursive scan previously used in template.visit_rule()
+    if node.nodeType == Node.ELEMENT_NODE:
+        if "RuleID" in node.attributes or "IdPrefix" in node.attributes:
+            return True
+        for n in node.childNodes:
+            if child_has_ruleid_or_prefix(n): return True
+
+def optional_flags(fn, engine):
+    flags = []
+
+    def visit(rule, parent):
+        flags.append((rule.tag, rule.attribute, rule.bind, rule.optional))
+
+    for cr in concept_root.parse(fn, engine=engine):
+        try:
+            cs = [cr.applicability()]
+        except IndexError:
+            cs = []
+        for c in cs + list(cr.concepts()):
+            t = c.template()
+            if t is not None:
+                t.traverse(visit)
+    return flags
+
+@pytest.mark.parametrize("engine", ["minidom", "iterparse"])
+@pytest.mark.parametrize("fn", EXAMPLES, ids=os.path.basename)
+def test_optional_matches_recursive_scan(fn, engine, monkeypatch):
+    flags = optional_flags(fn, engine)
+    monkeypatch.setattr(template, "has_ruleid_or_prefix", lambda self, node: bool(child_has_ruleid_or_prefix(node)))
+    reference = optional_flags(fn, engine)
+    assert flags
+    assert flags == reference
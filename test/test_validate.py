@@ -0,0 +1,48 @@
+import os
+
+import ifcopenshell
+import ifcopenshell.guid
+
+from .. import concept_root, mvd
+
+REFERENCE_VIEW = os.path.join(os.path.dirname(__file__), "..", "mvd_examples", "officials", "ReferenceView_V1-2.mvdxml")
+
+def wall_with_type():
+    f = ifcopenshell.file(schema="IFC4")
+    wall = f.createIfcWall(ifcopenshell.guid.new(), Name="W")
+    wall_type = f.createIfcWallType(ifcopenshell.guid.new(), Name="WT", PredefinedType="STANDARD")
+    f.createIfcRelDefinesByType(ifcopenshell.guid.new(), RelatedObjects=[wall], RelatingType=wall_type)
+    return f, wall, wall_type
+
+def test_concept_roots_without_concepts():
+    # IfcTypeProduct, among others, only has an Applicability in the Reference View
+    f, wall, wall_type = wall_with_type()
+    crs = list(concept_root.parse(REFERENCE_VIEW, engine="iterparse"))
+    assert any(cr.entity == "IfcTypeProduct" and not list(cr.concepts()) for cr in crs)
+
+    result = mvd.validate_file(crs, f)
+    assert wall.id() in result.row_index
+    for cr, c, counts in result.summary():
+        assert sum(counts.values()) == len(result.entity_ids)
+
+def test_applicability():
+    f = ifcopenshell.file(schema="IFC4")
+    walls = [f.createIfcWall(ifcopenshell.guid.new(), Name="W%d" % i) for i in range(2)]
+    prop = f.createIfcPropertySingleValue("IsExternal", NominalValue=f.createIfcBoolean(True))
+    pset = f.createIfcPropertySet(ifcopenshell.guid.new(), Name="Pset_WallCommon", HasProperties=[prop])
+    f.createIfcRelDefinesByProperties(ifcopenshell.guid.new(), RelatedObjects=walls[:1], RelatingPropertyDefinition=pset)
+
+    fn = os.path.join(os.path.dirname(__file__), "..", "mvd_examples", "wall_extraction.mvdxml")
+    all_data, matrix = mvd.get_data(mvd.open_mvd(fn), f, spreadsheet_export=False)
+    # the filtering Concept APexternal selects the walls that get_data() keeps
+    applicable = set(all_data[0])
+    assert 0 < len(applicable) < len(walls)
+
+    result = mvd.validate_file(concept_root.parse(fn), f)
+    assert result.concepts and not any(mvd.is_applicability(c) for cr, c in result.concepts)
+    for wall in walls:
+        for column in range(len(result.concepts)):
+            if wall.GlobalId in applicable:
+                assert result.status(wall.id(), column) in (mvd.PASS, mvd.FAIL)
+            else:
+                assert result.status(wall.id(), column) == mvd.NOT_APPLICABLE